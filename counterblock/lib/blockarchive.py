@@ -0,0 +1,196 @@
+"""
+blockarchive: a local, append-only archive of the block payloads (incl. _messages) we get from counterpartyd
+
+Blocks deeper than MAX_REORG_NUM_BLOCKS never change, so once archived, a reparse can be fed from local disk
+instead of going back out to counterpartyd's get_blocks for every block.
+
+Layout (under config.data_dir): the archive is split into segments of ARCHIVE_SEGMENT_NUM_BLOCKS blocks each. Each
+segment has a data file holding zlib-compressed JSON block payloads back to back, and an index file of fixed size
+(block_index, offset, length) records into it. Both are only ever appended to (or truncated, on a deep reorg).
+"""
+import os
+import json
+import zlib
+import array
+import struct
+import logging
+
+from counterblock.lib import config, util
+
+ARCHIVE_SEGMENT_NUM_BLOCKS = 10000 #blocks per segment file
+ARCHIVE_INDEX_RECORD = struct.Struct('<iQI') #block_index, offset into the segment data file, length
+
+logger = logging.getLogger(__name__)
+
+class BlockArchive(object):
+    def __init__(self):
+        self.path = None
+        self.first_block_index = None #first block in the archive (archived blocks are contiguous from here)
+        self.offsets = array.array('L')
+        self.lengths = array.array('L')
+        self.pending = {} #block_index -> compressed payload, for blocks not yet deep enough to archive
+        self.meta = {}
+
+    def open(self):
+        self.path = os.path.join(config.data_dir, 'block_archive%s' % config.net_path_part)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        meta_path = os.path.join(self.path, 'meta.json')
+        self.meta = json.load(open(meta_path)) if os.path.exists(meta_path) else {}
+        self._load_index()
+        logger.info("Opened block archive at %s (%s)" % (self.path,
+            "blocks %i to %i" % (self.first_block_index, self.last_block_index()) if len(self.offsets) else "empty"))
+
+    def check_version(self, version_major, version_minor):
+        """the payloads we archive are only good for the counterpartyd DB version they came from"""
+        if self.meta.get('counterpartyd_db_version_major') == version_major \
+           and self.meta.get('counterpartyd_db_version_minor') == version_minor:
+            return
+        if len(self.offsets):
+            logger.warn("counterpartyd DB version changed (archived from %s.%s, counterpartyd is at %s.%s). Clearing block archive." % (
+                self.meta.get('counterpartyd_db_version_major'), self.meta.get('counterpartyd_db_version_minor'),
+                version_major, version_minor))
+        self.truncate(None)
+        self.meta = {'counterpartyd_db_version_major': version_major, 'counterpartyd_db_version_minor': version_minor}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    def last_block_index(self):
+        return self.first_block_index + len(self.offsets) - 1 if len(self.offsets) else None
+
+    def has(self, block_index):
+        return bool(len(self.offsets)) and self.first_block_index <= block_index <= self.last_block_index()
+
+    def get_blocks(self, start_block_index, end_block_index):
+        """returns the archived payloads for the given (inclusive) block range, which must be in the archive"""
+        assert self.has(start_block_index) and self.has(end_block_index)
+        blocks = []
+        f = None
+        for block_index in xrange(start_block_index, end_block_index + 1):
+            if f is None or block_index % ARCHIVE_SEGMENT_NUM_BLOCKS == 0:
+                if f: f.close()
+                f = open(self._segment_path(block_index, 'dat'), 'rb')
+            pos = block_index - self.first_block_index
+            f.seek(self.offsets[pos])
+            blocks.append(json.loads(zlib.decompress(f.read(self.lengths[pos]))))
+        f.close()
+        return blocks
+
+    def add(self, block, max_block_index):
+        """queue a block payload (as fetched from counterpartyd) for archiving. Blocks are written out once they
+        are more than MAX_REORG_NUM_BLOCKS below max_block_index (i.e. counterpartyd's last block)"""
+        next_block_index = self.last_block_index() + 1 if len(self.offsets) else None
+        if next_block_index is not None and block['block_index'] < next_block_index:
+            return #already have it (e.g. we are replaying from the archive)
+        self.pending[block['block_index']] = zlib.compress(json.dumps(block, separators=(',', ':')))
+
+        for block_index in sorted(self.pending.keys()):
+            if block_index > max_block_index - config.MAX_REORG_NUM_BLOCKS:
+                break
+            if next_block_index is not None and block_index > next_block_index:
+                #we lost the pending blocks in between (i.e. we were restarted near the tip). They are deep enough
+                # to be final now, so get them from counterpartyd again
+                self._fill_gap(next_block_index, block_index - 1)
+            self._append(block_index, self.pending.pop(block_index))
+            next_block_index = block_index + 1
+
+    def discard_pending(self, max_block_index):
+        """forget queued blocks above max_block_index (on rollback)"""
+        for block_index in self.pending.keys():
+            if block_index > max_block_index:
+                del self.pending[block_index]
+
+    def truncate(self, max_block_index):
+        """remove everything above max_block_index from the archive (or everything, if None)"""
+        self.discard_pending(max_block_index or 0)
+        if not len(self.offsets) or (max_block_index is not None and max_block_index >= self.last_block_index()):
+            return
+        if max_block_index is None or max_block_index < self.first_block_index:
+            num_blocks = 0
+        else:
+            num_blocks = max_block_index - self.first_block_index + 1
+        logger.warn("Truncating block archive to %s" % (max_block_index if num_blocks else "nothing"))
+        for segment_start in self._segment_starts():
+            if num_blocks and segment_start <= max_block_index:
+                if segment_start + ARCHIVE_SEGMENT_NUM_BLOCKS - 1 > max_block_index: #partially kept
+                    pos = num_blocks - 1
+                    keep_records = max_block_index - max(segment_start, self.first_block_index) + 1
+                    self._truncate_file(self._segment_path(segment_start, 'dat'), self.offsets[pos] + self.lengths[pos])
+                    self._truncate_file(self._segment_path(segment_start, 'idx'), keep_records * ARCHIVE_INDEX_RECORD.size)
+                continue
+            self._remove_segment(segment_start)
+        del self.offsets[num_blocks:]
+        del self.lengths[num_blocks:]
+        if not num_blocks:
+            self.first_block_index = None
+
+    def _fill_gap(self, start_block_index, end_block_index):
+        logger.info("Fetching blocks %i to %i for the block archive" % (start_block_index, end_block_index))
+        blocks = util.call_jsonrpc_api('get_blocks',
+            {'block_indexes': range(start_block_index, end_block_index + 1)}, abort_on_error=True)['result']
+        for block in blocks:
+            self._append(block['block_index'], zlib.compress(json.dumps(block, separators=(',', ':'))))
+
+    def _append(self, block_index, data):
+        assert not len(self.offsets) or block_index == self.last_block_index() + 1
+        with open(self._segment_path(block_index, 'dat'), 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+        #the index record goes in last, so a block whose data didn't make it to disk is never indexed
+        with open(self._segment_path(block_index, 'idx'), 'ab') as f:
+            f.write(ARCHIVE_INDEX_RECORD.pack(block_index, offset, len(data)))
+        if not len(self.offsets):
+            self.first_block_index = block_index
+        self.offsets.append(offset)
+        self.lengths.append(len(data))
+
+    def _load_index(self):
+        self.first_block_index = None
+        del self.offsets[:]
+        del self.lengths[:]
+        segment_starts = self._segment_starts()
+        for i, segment_start in enumerate(segment_starts):
+            data_path, index_path = self._segment_path(segment_start, 'dat'), self._segment_path(segment_start, 'idx')
+            data_size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+            index_data = open(index_path, 'rb').read()
+            data_end = 0
+            num_records = 0
+            for j in xrange(len(index_data) // ARCHIVE_INDEX_RECORD.size):
+                block_index, offset, length = ARCHIVE_INDEX_RECORD.unpack_from(index_data, j * ARCHIVE_INDEX_RECORD.size)
+                if (len(self.offsets) and block_index != self.last_block_index() + 1) or offset + length > data_size:
+                    break #torn write or gap
+                if not len(self.offsets):
+                    self.first_block_index = block_index
+                self.offsets.append(offset)
+                self.lengths.append(length)
+                data_end = offset + length
+                num_records += 1
+            self._truncate_file(data_path, data_end) #drop data past the last indexed block
+            if num_records * ARCHIVE_INDEX_RECORD.size != len(index_data):
+                #drop this record and everything after it, as we need the archive to be contiguous
+                logger.warn("Block archive segment %s is damaged or incomplete, truncating the archive after block %s" % (
+                    index_path, self.last_block_index()))
+                self._truncate_file(index_path, num_records * ARCHIVE_INDEX_RECORD.size)
+                for later_segment_start in segment_starts[i + 1:]:
+                    self._remove_segment(later_segment_start)
+                break
+
+    def _segment_starts(self):
+        return sorted([int(f[len('blocks_'):-len('.idx')]) for f in os.listdir(self.path)
+            if f.startswith('blocks_') and f.endswith('.idx')])
+
+    def _segment_path(self, block_index, ext):
+        return os.path.join(self.path, 'blocks_%08i.%s' % (block_index - block_index % ARCHIVE_SEGMENT_NUM_BLOCKS, ext))
+
+    def _remove_segment(self, segment_start):
+        for ext in ('dat', 'idx'):
+            if os.path.exists(self._segment_path(segment_start, ext)):
+                os.remove(self._segment_path(segment_start, ext))
+
+    def _truncate_file(self, path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+archive = BlockArchive()
@@ -6,10 +6,10 @@ import hashlib
 import json
 import datetime
 import decimal
+import itertools
+import collections
 
-from repoze.lru import lru_cache
-import bitcoin as bitcoinlib
-import bitcoin.rpc as bitcoin_rpc
+from repoze.lru import LRUCache
 from pycoin import encoding
 
 from counterblock.lib import config, util
@@ -122,13 +122,12 @@ def getaddressinfo(address):
     
     return None
 
-def gettransaction(tx_hash):
-    tx = get_cached_raw_transaction(tx_hash)
+def _format_transaction(tx):
     valueOut = 0
     for vout in tx['vout']:
         valueOut += vout['value']
     return {
-        'txid': tx_hash,
+        'txid': tx['txid'],
         'version': tx['version'],
         'locktime': tx['locktime'],
         'confirmations': tx['confirmations'] if 'confirmations' in tx else 0,
@@ -139,7 +138,15 @@ def gettransaction(tx_hash):
         'vin': tx['vin'],
         'vout': tx['vout']
     }
-    return None
+
+def gettransaction(tx_hash):
+    return _format_transaction(get_cached_raw_transaction(tx_hash))
+
+def gettransactions(tx_hashes):
+    """like gettransaction, for many transactions at once (with the ones not cached fetched in a single batch call).
+    Returns a dict of tx_hash -> transaction, for the ones the backend knows about"""
+    txs = get_cached_raw_transactions(tx_hashes)
+    return dict([(tx_hash, _format_transaction(tx)) for tx_hash, tx in txs.iteritems()])
 
 def get_pubkey_from_transactions(address, raw_transactions):
     #for each transaction we got back, extract the vin, pubkey, go through, convert it to binary, and see if it reduces down to the given address
@@ -163,93 +170,129 @@ def get_pubkey_for_address(address):
     else:
         addresses = [address]
     
-    pubkeys = []
-
-    for address in addresses:
-        raw_transactions = search_raw_transactions(address)
-        pubkey = get_pubkey_from_transactions(address, raw_transactions)
-        if pubkey: pubkeys.append(pubkey)
-
-    return pubkeys
+    #(the address lookups are independent, so do them concurrently for multisig addresses)
+    pubkeys = util.pmap(lambda address: get_pubkey_from_transactions(address, search_raw_transactions(address)),
+        addresses)
+    return [pubkey for pubkey in pubkeys if pubkey]
 
 
 ### Unconfirmed Transactions ###
 
 # cache
-UNCONFIRMED_ADDRINDEX = {}
-OLD_MEMPOOL = []
+UNCONFIRMED_ADDRINDEX_MAX_TXS = 20000 #max number of mempool txs to index (oldest indexed are evicted first past that)
+UNCONFIRMED_ADDRINDEX = {} #address -> {tx_hash: tx}
+UNCONFIRMED_TX_ADDRESSES = collections.OrderedDict() #tx_hash -> addresses it is indexed under, oldest first
+OLD_MEMPOOL = set()
+UNRESOLVED_PREVOUT_TXS = {} #tx_hash -> indexed tx some of whose spent outputs we couldn't look up yet (retried each update)
+PREVOUT_ADDRESSES_CACHE_SIZE = 100000
+PREVOUT_ADDRESSES_CACHE = LRUCache(PREVOUT_ADDRESSES_CACHE_SIZE) #tx_hash -> addresses of each of its outputs
+
+RAW_TX_CACHE_SIZE = 4096
+RAW_TX_BATCH_SIZE = 100 #max number of txs to ask the backend for per batch call
+RAW_TX_CACHE = LRUCache(RAW_TX_CACHE_SIZE) #tx_hash -> tx (as returned by getrawtransaction)
 
-@lru_cache(maxsize=4096)
 def get_cached_raw_transaction(tx_hash):
-    return bitcoind_rpc('getrawtransaction', [tx_hash, 1])
-
-@lru_cache(maxsize=8192)
-def get_cached_batch_raw_transactions(tx_hashes):
-    tx_hashes = json.loads(tx_hashes) # for lru_cache
-    call_id = 0
-    call_list = []
+    tx = RAW_TX_CACHE.get(tx_hash)
+    if tx is None:
+        tx = bitcoind_rpc('getrawtransaction', [tx_hash, 1])
+        RAW_TX_CACHE.put(tx_hash, tx)
+    return tx
+
+def get_cached_raw_transactions(tx_hashes):
+    """returns a dict of tx_hash -> tx for the given transactions that the backend knows about, fetching the ones
+    not in RAW_TX_CACHE in a single batch call (and caching them)"""
+    txs = {}
     for tx_hash in tx_hashes:
-        call_list.append({
+        tx = RAW_TX_CACHE.get(tx_hash)
+        if tx is not None:
+            txs[tx_hash] = tx
+    missing = [tx_hash for tx_hash in set(tx_hashes) if tx_hash not in txs]
+    if missing:
+        for tx_hash, tx in get_batch_raw_transactions(missing).iteritems():
+            RAW_TX_CACHE.put(tx_hash, tx)
+            txs[tx_hash] = tx
+    return txs
+
+def get_batch_raw_transactions(tx_hashes):
+    """fetches the given transactions from the backend in batch calls of up to RAW_TX_BATCH_SIZE. Returns a dict of
+    tx_hash -> tx, for the ones it found"""
+    txs = {}
+    for chunk in util.grouper(RAW_TX_BATCH_SIZE, tx_hashes):
+        call_list = [{
             "method": 'getrawtransaction',
             "params": [tx_hash, 1],
             "jsonrpc": "2.0",
             "id": call_id
-        })
-        call_id += 1
-
-    if config.TESTNET:
-        bitcoinlib.SelectParams('testnet')
-    proxy = bitcoin_rpc.Proxy(service_url=config.BACKEND_URL)
-    return proxy._batch(call_list)
+        } for call_id, tx_hash in enumerate(chunk)]
+        for response in util.call_jsonrpc_api_batch(call_list, endpoint=config.BACKEND_URL_NOAUTH, auth=config.BACKEND_AUTH):
+            if 'error' not in response or response['error'] is None:
+                if 'result' in response and response['result'] is not None:
+                    txs[response['result']['txid']] = response['result']
+    return txs
+
+def cache_prevout_addresses(tx):
+    PREVOUT_ADDRESSES_CACHE.put(tx['txid'],
+        [vout['scriptPubKey'].get('addresses', []) for vout in tx['vout']])
+
+def resolve_prevouts(txs):
+    """makes sure the outputs spent by txs are in PREVOUT_ADDRESSES_CACHE, fetching all the parent txs that aren't
+    (once each) in a single batch call"""
+    parent_tx_hashes = set([vin['txid'] for tx in txs for vin in tx['vin']
+        if 'txid' in vin and PREVOUT_ADDRESSES_CACHE.get(vin['txid']) is None])
+    if parent_tx_hashes:
+        for parent_tx in get_batch_raw_transactions(list(parent_tx_hashes)).itervalues():
+            cache_prevout_addresses(parent_tx)
 
 # TODO: use scriptpubkey_to_address()
-@lru_cache(maxsize=4096)
 def extract_addresses(tx):
-    tx = json.loads(tx) # for lru_cache
+    """the addresses tx pays to and spends from. Spent outputs must have been looked up with resolve_prevouts first:
+    returns (addresses, tx hashes of the spent outputs that weren't)"""
     addresses = []
+    unresolved = []
 
     for vout in tx['vout']:
         if 'addresses' in vout['scriptPubKey']:
             addresses += vout['scriptPubKey']['addresses']
 
-    vin_hashes = [vin['txid'] for vin in tx['vin']]        
-    batch_responses = get_cached_batch_raw_transactions(json.dumps(vin_hashes))
-    tx_dict = {}
-    for response in batch_responses:
-        if 'error' not in response or response['error'] is None:
-            if 'result' in response and response['result'] is not None:
-                vin_tx = response['result']
-                tx_dict[vin_tx['txid']] = vin_tx
-
     for vin in tx['vin']:
-        vin_tx = tx_dict[vin['txid']]
-        vout = vin_tx['vout'][vin['vout']]
-        if 'addresses' in vout['scriptPubKey']:
-            addresses += vout['scriptPubKey']['addresses']
-
-    return addresses
+        if 'txid' not in vin: continue #coinbase
+        vout_addresses = PREVOUT_ADDRESSES_CACHE.get(vin['txid'])
+        if vout_addresses is not None:
+            addresses += vout_addresses[vin['vout']]
+        else:
+            unresolved.append(vin['txid'])
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, D):
-            return format(obj, '.8f')
-        # Let the base class default method raise the TypeError
-        return json.JSONEncoder.default(self, obj)
+    return addresses, unresolved
 
 def add_tx_to_addrindex(tx):
     global UNCONFIRMED_ADDRINDEX
 
-    addresses = extract_addresses(json.dumps(tx, cls=DecimalEncoder))
+    if tx['txid'] in UNCONFIRMED_TX_ADDRESSES:
+        remove_tx_from_addrindex(tx['txid'])
+    addresses, unresolved = extract_addresses(tx)
+    addresses = set(addresses)
+    if unresolved:
+        UNRESOLVED_PREVOUT_TXS[tx['txid']] = tx
+    else:
+        UNRESOLVED_PREVOUT_TXS.pop(tx['txid'], None)
     for address in addresses:
         if address not in UNCONFIRMED_ADDRINDEX:
             UNCONFIRMED_ADDRINDEX[address] = {}
         UNCONFIRMED_ADDRINDEX[address][tx['txid']] = tx
+    UNCONFIRMED_TX_ADDRESSES[tx['txid']] = addresses
+    invalidate_unspent_txouts(addresses)
+
+    while len(UNCONFIRMED_TX_ADDRESSES) > UNCONFIRMED_ADDRINDEX_MAX_TXS:
+        remove_tx_from_addrindex(next(iter(UNCONFIRMED_TX_ADDRESSES)))
 
 def remove_tx_from_addrindex(tx_hash):
     global UNCONFIRMED_ADDRINDEX
 
-    for address in list(UNCONFIRMED_ADDRINDEX.keys()):
-        if tx_hash in UNCONFIRMED_ADDRINDEX[address]:
+    addresses = UNCONFIRMED_TX_ADDRESSES.pop(tx_hash, [])
+    UNRESOLVED_PREVOUT_TXS.pop(tx_hash, None)
+    invalidate_unspent_txouts(addresses)
+    for address in addresses:
+        if tx_hash in UNCONFIRMED_ADDRINDEX.get(address, {}):
             UNCONFIRMED_ADDRINDEX[address].pop(tx_hash)
             if len(UNCONFIRMED_ADDRINDEX[address]) == 0:
                 UNCONFIRMED_ADDRINDEX.pop(address)
@@ -265,39 +308,74 @@ def unconfirmed_transactions(address):
 def update_unconfirmed_addrindex():
     global OLD_MEMPOOL
 
-    new_mempool = bitcoind_rpc('getrawmempool', [])
+    new_mempool = set(bitcoind_rpc('getrawmempool', []))
 
     # remove confirmed txs
-    for tx_hash in OLD_MEMPOOL:
-        if tx_hash not in new_mempool:
-            remove_tx_from_addrindex(tx_hash)
-
-    # add new txs
-    new_tx_hashes = []
-    for tx_hash in new_mempool:
-        if tx_hash not in OLD_MEMPOOL:
-            new_tx_hashes.append(tx_hash)
-
-    if len(new_tx_hashes) > 0:
-        batch_responses = get_cached_batch_raw_transactions(json.dumps(new_tx_hashes))
-        for response in batch_responses:
-            if 'error' not in response or response['error'] is None:
-                if 'result' in response and response['result'] is not None:
-                    tx = response['result']
-                    add_tx_to_addrindex(tx)
-
-    OLD_MEMPOOL = list(new_mempool)
-
-def search_raw_transactions(address):
-    unconfirmed = unconfirmed_transactions(address)
+    for tx_hash in OLD_MEMPOOL - new_mempool:
+        remove_tx_from_addrindex(tx_hash)
+
+    # add new txs (when there are more than we can index, the ones we don't index are still marked as seen)
+    new_tx_hashes = list(new_mempool - OLD_MEMPOOL)[:UNCONFIRMED_ADDRINDEX_MAX_TXS]
+
+    new_txs = get_batch_raw_transactions(new_tx_hashes).values() if new_tx_hashes else []
+    for tx in new_txs:
+        cache_prevout_addresses(tx)
+    #and the ones we indexed before without all their spent outputs, to try those again
+    txs = UNRESOLVED_PREVOUT_TXS.values() + new_txs
+    if txs:
+        #one more batch call for all of their parents we don't have yet (some may be among new_txs themselves)
+        resolve_prevouts(txs)
+        for tx in txs:
+            add_tx_to_addrindex(tx)
+        if UNRESOLVED_PREVOUT_TXS:
+            logger.warn("Could not look up the spent outputs of %i mempool tx(s), some addresses they spend from are "
+                "not indexed yet (will retry)" % len(UNRESOLVED_PREVOUT_TXS))
+
+    OLD_MEMPOOL = new_mempool
+
+SEARCH_RAW_TRANSACTIONS_PAGE_SIZE = 1000 #txs to ask the backend for per searchrawtransactions call
+ADDRESS_TXS_CACHE_SIZE = 500 #max number of addresses to cache confirmed txs for
+ADDRESS_TXS_CACHE = LRUCache(ADDRESS_TXS_CACHE_SIZE)
+#^ address -> txs deeper than MAX_REORG_NUM_BLOCKS, oldest first, as returned by the backend (less the 'hex' field),
+# each with the block height it was confirmed at (_height)
+
+def _search_raw_transactions_page(address, skip, count):
     try:
-        rawtransactions = bitcoind_rpc('searchrawtransactions', [address, 1, 0, 9999999])
+        return bitcoind_rpc('searchrawtransactions', [address, 1, skip, count])
     except Exception, e:
         if str(e).find('404') != -1:
             raise Exception('Unknown RPC command: searchrawtransactions. Switch to jmcorgan.')
+        elif skip and str(e).find('No information available') != -1: #paged past the end
+            return []
         else:
             raise Exception(str(e))
-    confirmed = [tx for tx in rawtransactions if tx['confirmations'] > 0]
+
+@util.request_memoized
+def search_raw_transactions(address):
+    unconfirmed = unconfirmed_transactions(address)
+    block_count = bitcoind_rpc('getblockcount', [])
+
+    #txs come back oldest first, so we only need to page through what came after the ones we have cached
+    cached = ADDRESS_TXS_CACHE.get(address) or []
+    fetched = []
+    while True:
+        page = _search_raw_transactions_page(address, len(cached) + len(fetched), SEARCH_RAW_TRANSACTIONS_PAGE_SIZE)
+        fetched += page
+        if len(page) < SEARCH_RAW_TRANSACTIONS_PAGE_SIZE:
+            break
+
+    new_block_count = bitcoind_rpc('getblockcount', [])
+    if new_block_count == block_count: #(otherwise we can't tell the heights of what we fetched)
+        deep = [dict([(k, v) for k, v in tx.iteritems() if k != 'hex'], _height=block_count - tx['confirmations'] + 1)
+            for tx in itertools.takewhile(
+                lambda tx: tx.get('confirmations', 0) > config.MAX_REORG_NUM_BLOCKS, fetched)]
+        if deep:
+            ADDRESS_TXS_CACHE.put(address, cached + deep)
+    block_count = new_block_count
+
+    confirmed = [dict([(k, v) for k, v in tx.iteritems() if k != '_height'], confirmations=block_count - tx['_height'] + 1)
+        for tx in cached] \
+        + [tx for tx in fetched if tx.get('confirmations', 0) > 0]
     return unconfirmed + confirmed
 
 ### Multi-signature Addresses ###
@@ -359,10 +437,46 @@ def scriptpubkey_to_canonical_address(scriptpubkey):
         return None
 
 
+UNSPENT_TXOUTS_CACHE_SIZE = 1000
+UNSPENT_TXOUTS_CACHE = LRUCache(UNSPENT_TXOUTS_CACHE_SIZE)
+#^ source -> (backend block index, address generations, unspent, confirmed_unspent)
+UNSPENT_TXOUTS_CACHE_BLOCK_INDEX = None
+ADDRESS_GENERATIONS = {} #address -> number of mempool changes that touched it since the last block
+
+def invalidate_unspent_txouts(addresses):
+    """called when a mempool tx touching these addresses comes or goes, to invalidate their cached unspent txouts
+    (including for any multisig sources they are a part of)"""
+    for address in addresses:
+        ADDRESS_GENERATIONS[address] = ADDRESS_GENERATIONS.get(address, 0) + 1
+
 def get_unspent_txouts(source, return_confirmed=False):
     """returns a list of unspent outputs for a specific address
     @return: A list of dicts, with each entry in the dict having the following keys:
     """
+    global UNSPENT_TXOUTS_CACHE_BLOCK_INDEX, ADDRESS_GENERATIONS
+    #cached results are good until the next block, or until a mempool tx touches (one of) the address(es)
+    if config.state.get('cp_backend_block_index', None) != UNSPENT_TXOUTS_CACHE_BLOCK_INDEX:
+        UNSPENT_TXOUTS_CACHE.clear()
+        ADDRESS_GENERATIONS = {}
+        UNSPENT_TXOUTS_CACHE_BLOCK_INDEX = config.state.get('cp_backend_block_index', None)
+    pubkeyhashes = pubkeyhash_array(source) if is_multisig(source) else [source]
+    generations = tuple([ADDRESS_GENERATIONS.get(address, 0) for address in pubkeyhashes])
+
+    cached = UNSPENT_TXOUTS_CACHE.get(source)
+    if cached is not None and cached[:2] == (UNSPENT_TXOUTS_CACHE_BLOCK_INDEX, generations):
+        unspent, confirmed_unspent = cached[2:]
+    else:
+        unspent, confirmed_unspent = find_unspent_txouts(source)
+        UNSPENT_TXOUTS_CACHE.put(source, (UNSPENT_TXOUTS_CACHE_BLOCK_INDEX, generations, unspent, confirmed_unspent))
+
+    if return_confirmed:
+        return unspent, confirmed_unspent
+    else:
+        return unspent
+
+@util.request_memoized
+def find_unspent_txouts(source):
+    """returns (unspent, confirmed_unspent) lists of outputs for source (uncached)"""
     # Get all coins.
     outputs = {}
     if is_multisig(source):
@@ -392,30 +506,36 @@ def get_unspent_txouts(source, return_confirmed=False):
     outputs = outputs.values()
 
     # Prune away spent coins.
+    spent = set() #(txid, vout) of all outpoints spent by the address's txs
+    confirmed_spent = set()
+    for tx in raw_transactions:
+        confirmed = 'confirmations' in tx and tx['confirmations'] > 0
+        for vin in tx['vin']:
+            if 'coinbase' in vin: continue
+            spent.add((vin['txid'], vin['vout']))
+            if confirmed:
+                confirmed_spent.add((vin['txid'], vin['vout']))
     unspent = []
     confirmed_unspent = []
     for output in outputs:
-        spent = False
-        confirmed_spent = False
-        for tx in raw_transactions:
-            for vin in tx['vin']:
-                if 'coinbase' in vin: continue
-                if (vin['txid'], vin['vout']) == (output['txid'], output['vout']):
-                    spent = True
-                    if 'confirmations' in tx and tx['confirmations'] > 0:
-                        confirmed_spent = True
-        if not spent:
+        if (output['txid'], output['vout']) not in spent:
             unspent.append(output)
-        if not confirmed_spent and output['confirmations'] > 0:
+        if (output['txid'], output['vout']) not in confirmed_spent and output['confirmations'] > 0:
             confirmed_unspent.append(output)
 
     unspent = sorted(unspent, key=lambda x: x['txid'])
     confirmed_unspent = sorted(confirmed_unspent, key=lambda x: x['txid'])
-
-    if return_confirmed:
-        return unspent, confirmed_unspent
-    else:
-        return unspent
+    return unspent, confirmed_unspent
 
 def broadcast_tx(signed_tx_hex):
-    return bitcoind_rpc('sendrawtransaction', [signed_tx_hex])
+    tx_hash = bitcoind_rpc('sendrawtransaction', [signed_tx_hex])
+    #index it right away rather than when we next poll the mempool, so the outputs it spends stop being handed out
+    # as unspent (and the cached unspent txouts of the addresses involved are invalidated)
+    try:
+        tx = bitcoind_rpc('decoderawtransaction', [signed_tx_hex])
+        cache_prevout_addresses(tx)
+        resolve_prevouts([tx])
+        add_tx_to_addrindex(tx)
+    except Exception, e: #(it went out, so don't fail the broadcast over this)
+        logger.warn("Could not index broadcast tx %s ahead of the mempool poll: %s" % (tx_hash, e))
+    return tx_hash
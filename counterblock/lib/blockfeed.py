@@ -15,8 +15,8 @@ import itertools
 import pymongo
 import gevent
 
-from counterblock.lib import config, util, blockchain, cache, database
-from counterblock.lib.processor import MessageProcessor, MempoolMessageProcessor, BlockProcessor, CaughtUpProcessor
+from counterblock.lib import config, util, blockchain, cache, database, blockarchive
+from counterblock.lib.processor import MessageProcessor, MempoolMessageProcessor, BlockProcessor, CaughtUpProcessor, STATS_PROCESSORS, log_processor_stats
 
 D = decimal.Decimal 
 logger = logging.getLogger(__name__)
@@ -44,41 +44,55 @@ def process_cp_blockfeed():
     #enabled processor functions
     logger.debug("Enabled Message Processor Functions {0}".format(MessageProcessor.active_functions()))
     logger.debug("Enabled Block Processor Functions {0}".format(BlockProcessor.active_functions()))
+    if config.PROCESSOR_STATS:
+        for processor in STATS_PROCESSORS.itervalues():
+            processor.enable_stats()
     
+    #what we have in the mempool collection: tx_hash -> viewed_in_block, and the latest counterpartyd timestamp seen.
+    # Loaded on first use, and kept in step with the collection by publish_mempool_tx and clean_mempool_tx
+    mempool_seen = {'tx_hashes': None, 'last_timestamp': 0}
+
+    def load_mempool_seen():
+        mempool_seen['tx_hashes'] = {}
+        for mempool_tx in config.mongo_db.mempool.find(fields={'tx_hash': True, 'timestamp': True, 'viewed_in_block': True}):
+            mempool_seen['tx_hashes'][str(mempool_tx['tx_hash'])] = mempool_tx['viewed_in_block']
+            mempool_seen['last_timestamp'] = max(mempool_seen['last_timestamp'], mempool_tx['timestamp'])
+
     def publish_mempool_tx():
         """fetch new tx from mempool"""
-        tx_hashes = []
-        mempool_txs = config.mongo_db.mempool.find(fields={'tx_hash': True})
-        for mempool_tx in mempool_txs:
-            tx_hashes.append(str(mempool_tx['tx_hash']))
-    
-        params = None
-        if len(tx_hashes) > 0:
-            params = {
-                'filters': [
-                    {'field':'tx_hash', 'op': 'NOT IN', 'value': tx_hashes},
-                    {'field':'category', 'op': 'IN', 'value': ['sends', 'btcpays', 'issuances', 'dividends']}
-                ],
-                'filterop': 'AND'
-            }
-        new_txs = util.jsonrpc_api("get_mempool", params, abort_on_error=True)
+        if mempool_seen['tx_hashes'] is None:
+            load_mempool_seen()
+
+        #only ask for what came in since the last tx we saw (and weed out the ones we already have below)
+        filters = [{'field':'category', 'op': 'IN', 'value': ['sends', 'btcpays', 'issuances', 'dividends']}]
+        if mempool_seen['last_timestamp']:
+            filters.append({'field':'timestamp', 'op': '>=', 'value': mempool_seen['last_timestamp']})
+        new_txs = util.jsonrpc_api("get_mempool", {'filters': filters, 'filterop': 'AND'}, abort_on_error=True)
     
+        txs = []
         for new_tx in new_txs['result']:
-            tx = {
+            if new_tx['tx_hash'] in mempool_seen['tx_hashes']:
+                continue
+            txs.append({
                 'tx_hash': new_tx['tx_hash'],
                 'command': new_tx['command'],
                 'category': new_tx['category'],
                 'bindings': new_tx['bindings'],
                 'timestamp': new_tx['timestamp'],
                 'viewed_in_block': config.state['my_latest_block']['block_index']
-            }
-            
-            config.mongo_db.mempool.insert(tx)
+            })
+            mempool_seen['tx_hashes'][str(new_tx['tx_hash'])] = txs[-1]['viewed_in_block']
+            mempool_seen['last_timestamp'] = max(mempool_seen['last_timestamp'], new_tx['timestamp'])
+        if not txs:
+            return
+        config.mongo_db.mempool.insert(txs)
+    
+        for tx in txs:
             del(tx['_id'])
             tx['_category'] = tx['category']
             tx['_message_index'] = 'mempool'
             logger.debug("Spotted mempool tx: %s" % tx)
-            for function in MempoolMessageProcessor.active_functions():
+            for function in MempoolMessageProcessor.active_functions_for(tx['category'], tx['command']):
                 logger.debug('starting {} (mempool)'.format(function['function']))
                 # TODO: Better handling of double parsing
                 try:
@@ -89,8 +103,12 @@ def process_cp_blockfeed():
             
     def clean_mempool_tx():
         """clean mempool transactions older than MAX_REORG_NUM_BLOCKS blocks"""
-        config.mongo_db.mempool.remove(
-            {"viewed_in_block": {"$lt": config.state['my_latest_block']['block_index'] - config.MAX_REORG_NUM_BLOCKS}})
+        min_block_index = config.state['my_latest_block']['block_index'] - config.MAX_REORG_NUM_BLOCKS
+        config.mongo_db.mempool.remove({"viewed_in_block": {"$lt": min_block_index}})
+        if mempool_seen['tx_hashes'] is not None:
+            for tx_hash in [tx_hash for tx_hash, viewed_in_block in mempool_seen['tx_hashes'].iteritems()
+              if viewed_in_block < min_block_index]:
+                del mempool_seen['tx_hashes'][tx_hash]
 
     def parse_message(msg): 
         msg_data = json.loads(msg['bindings'])
@@ -99,7 +117,7 @@ def process_cp_blockfeed():
         #out of order messages should not happen (anymore), but just to be sure
         assert msg['message_index'] == config.state['last_message_index'] + 1 or config.state['last_message_index'] == -1
         
-        for function in MessageProcessor.active_functions():
+        for function in MessageProcessor.active_functions_for(msg['category'], msg['command']):
             logger.debug('starting {}'.format(function['function']))
             # TODO: Better handling of double parsing
             try:
@@ -132,15 +150,23 @@ def process_cp_blockfeed():
             'block_time': config.state['cur_block']['block_time_obj'],
             'block_hash': config.state['cur_block']['block_hash'],
         }
-        config.mongo_db.processed_blocks.insert(new_block)
+        database.write_buffer.insert('processed_blocks', new_block)
+        cache.block_index.append(new_block['block_index'], new_block['block_time'])
         
         config.state['my_latest_block'] = new_block 
+        database.write_buffer.block_done()
+        if not database.write_buffer.enabled and new_block['block_index'] % database.UNDO_LOG_PRUNE_NUM_BLOCKS == 0:
+            database.undo_log.prune(new_block['block_index'])
 
         logger.info("Block: %i of %i [message height=%s]" % (
             config.state['my_latest_block']['block_index'],
             config.state['cp_backend_block_index'] \
                 if config.state['cp_backend_block_index'] else '???',
             config.state['last_message_index'] if config.state['last_message_index'] != -1 else '???'))
+        if config.PROCESSOR_STATS and config.state['my_latest_block']['block_index'] % config.PROCESSOR_STATS_LOG_NUM_BLOCKS == 0:
+            log_processor_stats()
+            logger.info("Cache stats: tracked assets %s, block cache %s" % (
+                cache.tracked_asset_cache.get_stats(), cache.block_results.get_stats()))
 
         if config.state['cp_latest_block_index'] - cur_block_index < config.MAX_REORG_NUM_BLOCKS: #only when we are near the tip
             clean_mempool_tx()
@@ -171,6 +197,9 @@ def process_cp_blockfeed():
         else:
             #no block state in the database yet
             config.state['my_latest_block'] = config.LATEST_BLOCK_INIT
+    cache.block_index.load()
+    if config.BLOCK_ARCHIVE:
+        blockarchive.archive.open()
     
     #avoid contacting counterpartyd (on reparse, to speed up)
     autopilot = False
@@ -224,6 +253,10 @@ def process_cp_blockfeed():
             config.state['my_latest_block'] = config.LATEST_BLOCK_INIT
             config.state['caught_up'] = False #You've Come a Long Way, Baby
             
+        if config.BLOCK_ARCHIVE:
+            #archived block data is only good for the counterpartyd DB version it was fetched from
+            blockarchive.archive.check_version(cp_running_info['version_major'], cp_running_info['version_minor'])
+
         #work up to what block counterpartyd is at
         config.state['cp_latest_block_index'] = cp_running_info['last_block']['block_index'] \
             if isinstance(cp_running_info['last_block'], dict) else cp_running_info['last_block']
@@ -246,11 +279,12 @@ def process_cp_blockfeed():
                 autopilot_runner -= 1
             else:
                 autopilot = False
+            #far from the tip, have processors buffer their writes and flush them out in bulk
+            database.write_buffer.set_enabled(autopilot)
                 
             cur_block_index = config.state['my_latest_block']['block_index'] + 1
             try:
-                block_data = cache.get_block_info(cur_block_index,
-                    min(100, (config.state['cp_latest_block_index'] - config.state['my_latest_block']['block_index'])))
+                block_data = cache.get_block_info(cur_block_index, config.state['cp_latest_block_index'])
             except Exception, e:
                 logger.warn(str(e) + " Waiting 3 seconds before trying again...")
                 time.sleep(3)
@@ -260,6 +294,8 @@ def process_cp_blockfeed():
             if config.state['cp_latest_block_index'] - cur_block_index <= config.MAX_REORG_NUM_BLOCKS: #only when we are near the tip
                 cache.clean_block_cache(cur_block_index)
 
+            if config.BLOCK_ARCHIVE:
+                blockarchive.archive.add(block_data, config.state['cp_latest_block_index'])
             parse_block(block_data)
 
         elif config.state['my_latest_block']['block_index'] > config.state['cp_latest_block_index']:
@@ -268,6 +304,8 @@ def process_cp_blockfeed():
             logger.error("Very odd: Ahead of counterpartyd with block indexes! Pruning back %s blocks to be safe."
                 % config.MAX_REORG_NUM_BLOCKS)
             database.rollback(config.state['cp_latest_block_index'] - config.MAX_REORG_NUM_BLOCKS)
+            if config.BLOCK_ARCHIVE:
+                blockarchive.archive.truncate(config.state['cp_latest_block_index'] - config.MAX_REORG_NUM_BLOCKS)
         else:
             #...we may be caught up (to counterpartyd), but counterpartyd may not be (to the blockchain). And if it isn't, we aren't
             config.state['caught_up'] = cp_running_info['db_caught_up']
@@ -1,13 +1,23 @@
 import os
+import time
 import hashlib
 import logging
 import json
+import array
+import bisect
+import calendar
+import datetime
+import collections
+import pymongo
 import gevent
+import gevent.event
+import gevent.queue
 import redis
 import redis.connection
 redis.connection.socket = gevent.socket #make redis play well with gevent
+from repoze.lru import LRUCache
 
-from counterblock.lib import config, util
+from counterblock.lib import config, util, blockarchive
 
 logger = logging.getLogger(__name__)
 
@@ -21,45 +31,398 @@ def get_redis_connection():
 ##
 ## NOT REDIS RELATED
 ##
-blockinfo_cache = {} 
-def get_block_info(block_index, prefetch=0):
-    global blockinfo_cache
-    if block_index in blockinfo_cache:
-        return blockinfo_cache[block_index]
-    blockinfo_cache.clear()
-    blocks = util.call_jsonrpc_api('get_blocks',
-                              {'block_indexes': range(block_index, block_index + prefetch)},
-                              abort_on_error=True)['result']
-    for block in blocks:
-        blockinfo_cache[block['block_index']] = block
-    return blockinfo_cache[block_index]
+BLOCK_PREFETCH_QUEUE_SIZE = 4 #max number of block batches to hold fetched ahead of the block being parsed
+BLOCK_PREFETCH_MIN_BATCH_SIZE = 1
+BLOCK_PREFETCH_MAX_BATCH_SIZE = 500
+BLOCK_PREFETCH_INITIAL_BATCH_SIZE = 50
+BLOCK_PREFETCH_TARGET_FETCH_TIME = 1.0 #seconds we aim for each get_blocks call to take
+BLOCK_PREFETCH_TARGET_BATCH_BYTES = 2 * 1024 * 1024 #approx. message payload we aim for each batch to carry
+
+class BlockPrefetcher(object):
+    """Keeps a bounded queue of upcoming block batches from counterpartyd filled from a background greenlet,
+    so that fetching the next blocks overlaps with the parsing of the current one"""
+    def __init__(self):
+        self.fetcher = None #fetcher greenlet
+        self.queue = None
+        self.batch = {} #block_index -> block, for the batch currently being consumed
+        self.next_block_index = None #first block index of the next batch we expect off the queue
+        self.max_block_index = 0 #never fetch past this (i.e. counterpartyd's last block)
+        self.more_blocks = gevent.event.Event()
+        self.batch_size = BLOCK_PREFETCH_INITIAL_BATCH_SIZE
+
+    def reset(self):
+        """drop everything fetched so far (e.g. on rollback)"""
+        if self.fetcher is not None:
+            self.fetcher.kill()
+        self.fetcher = None
+        self.queue = None
+        self.batch = {}
+        self.next_block_index = None
+
+    def get(self, block_index, max_block_index):
+        if block_index in self.batch:
+            return self.batch.pop(block_index)
+        self.batch = {}
+
+        if max_block_index > self.max_block_index:
+            self.more_blocks.set()
+        self.max_block_index = max_block_index
+        if self.fetcher is None or block_index != self.next_block_index:
+            self._start(block_index)
+
+        result = self.queue.get()
+        if isinstance(result, Exception):
+            self.reset()
+            raise result
+        if not result or result[0]['block_index'] != block_index:
+            self.reset()
+            raise Exception("get_blocks did not return block %i" % block_index)
+        self.batch = dict([(block['block_index'], block) for block in result])
+        self.next_block_index = result[-1]['block_index'] + 1
+        return self.batch.pop(block_index)
+
+    def _start(self, block_index):
+        self.reset()
+        self.queue = gevent.queue.Queue(BLOCK_PREFETCH_QUEUE_SIZE)
+        self.next_block_index = block_index
+        self.fetcher = gevent.spawn(self._fetch_batches, block_index, self.queue)
+
+    def _fetch_batches(self, block_index, queue):
+        while True:
+            while block_index > self.max_block_index:
+                self.more_blocks.clear()
+                self.more_blocks.wait()
+            if config.BLOCK_ARCHIVE and blockarchive.archive.has(block_index):
+                #replay from the local archive rather than going out to counterpartyd
+                end_block_index = min(block_index + BLOCK_PREFETCH_MAX_BATCH_SIZE - 1,
+                    blockarchive.archive.last_block_index(), self.max_block_index)
+                try:
+                    blocks = blockarchive.archive.get_blocks(block_index, end_block_index)
+                except Exception, e:
+                    queue.put(e)
+                    return
+                queue.put(blocks)
+                block_index = end_block_index + 1
+                continue
+            batch_size = self.batch_size
+            end_block_index = min(block_index + batch_size - 1, self.max_block_index)
+
+            start_time = time.time()
+            try:
+                blocks = util.call_jsonrpc_api('get_blocks',
+                    {'block_indexes': range(block_index, end_block_index + 1)}, abort_on_error=True)['result']
+            except Exception, e:
+                queue.put(e) #raised to the consumer, who will restart us on its next call
+                return
+            if end_block_index - block_index + 1 == batch_size: #don't adapt off of batches cut short by the tip
+                payload_size = sum([len(msg['bindings']) for block in blocks for msg in block['_messages']])
+                self._adapt_batch_size(time.time() - start_time, payload_size)
+
+            queue.put(blocks) #blocks while the queue is full
+            block_index = end_block_index + 1
+
+    def _adapt_batch_size(self, fetch_time, payload_size):
+        #scale towards whichever target we hit first, by at most a factor of 2 per batch so a single
+        # outlier (e.g. counterpartyd stalling briefly) doesn't swing us around
+        scale = min(BLOCK_PREFETCH_TARGET_FETCH_TIME / max(fetch_time, 0.001),
+                    BLOCK_PREFETCH_TARGET_BATCH_BYTES / float(max(payload_size, 1)))
+        scale = max(0.5, min(2.0, scale))
+        batch_size = int(max(BLOCK_PREFETCH_MIN_BATCH_SIZE, min(BLOCK_PREFETCH_MAX_BATCH_SIZE, self.batch_size * scale)))
+        if batch_size != self.batch_size:
+            logger.debug("Block prefetch batch size %i -> %i (fetch took %.2fs, payload %i bytes)" % (
+                self.batch_size, batch_size, fetch_time, payload_size))
+        self.batch_size = batch_size
+
+block_prefetcher = BlockPrefetcher()
+
+def get_block_info(block_index, max_block_index):
+    """get the block data for block_index from counterpartyd, prefetching following blocks up to max_block_index"""
+    return block_prefetcher.get(block_index, max_block_index)
+
+class LoadTracker(object):
+    """Keeps track of the keys a cache is loading from mongo (which yields to other greenlets), so that a load that
+    raced with a put() or a rollback for the same key doesn't fill the cache with what is by then a stale doc"""
+    def __init__(self):
+        self.loading = {} #key -> number of loads in flight
+        self.stale = set() #keys changed while being loaded
+
+    def start(self, key):
+        self.loading[key] = self.loading.get(key, 0) + 1
+
+    def finish(self, key):
+        """returns whether what was loaded can be cached"""
+        fresh = key not in self.stale
+        self.loading[key] -= 1
+        if not self.loading[key]:
+            del self.loading[key]
+            self.stale.discard(key)
+        return fresh
+
+    def invalidate(self, key=None):
+        """marks key (or everything, if None) as changed"""
+        if key is None:
+            self.stale.update(self.loading.keys())
+        elif key in self.loading:
+            self.stale.add(key)
+
+BALANCE_INDEX_MAX_SIZE = 50000 #max number of (address, asset) pairs to hold the latest balance change for
+
+class LatestBalanceIndex(object):
+    """Process-local map of (address, asset) -> latest balance_changes record (or None if there is none), warmed
+    lazily from mongo and evicted least-recently-used first. Writers of balance_changes must put() every record they
+    write, and rollback() must be called whenever balance_changes is pruned, to keep this exact."""
+    def __init__(self, max_size=BALANCE_INDEX_MAX_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.loads = LoadTracker()
+
+    def get(self, address, asset):
+        key = (address, asset)
+        if key in self.entries:
+            bal_change = self.entries.pop(key)
+            self._store(key, bal_change)
+            return bal_change
+        self.loads.start(key)
+        try:
+            bal_change = config.mongo_db.balance_changes.find_one({
+                'address': address,
+                'asset': asset
+            }, sort=[("block_index", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        finally:
+            fresh = self.loads.finish(key)
+        if fresh and key not in self.entries:
+            self._store(key, bal_change)
+        return bal_change
+
+    def put(self, address, asset, bal_change):
+        key = (address, asset)
+        self.loads.invalidate(key)
+        self.entries.pop(key, None)
+        self._store(key, bal_change)
+
+    def _store(self, key, bal_change):
+        self.entries[key] = bal_change
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def rollback(self, max_block_index):
+        """drop records newer than max_block_index (so they will be reloaded), or everything on a full reparse"""
+        self.loads.invalidate()
+        if not max_block_index:
+            self.entries.clear()
+            return
+        for key, bal_change in self.entries.items():
+            if bal_change and bal_change['block_index'] > max_block_index:
+                del self.entries[key]
+
+balance_index = LatestBalanceIndex()
+
+TRACKED_ASSET_CACHE_MAX_SIZE = 50000 #max number of asset names (that exist or not) to hold the tracked asset for
+
+class TrackedAssetCache(object):
+    """Process-wide cache of tracked_assets records by asset name (without the _id field), including
+    assets that don't exist, evicted least-recently-used first (as the API looks up whatever names it is given).
+    assets.parse_issuance keeps it current and assets.process_rollback clears it.
+    Callers must treat what get() returns as read-only"""
+    def __init__(self, max_size=TRACKED_ASSET_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.assets = collections.OrderedDict()
+        self.loads = LoadTracker()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, asset):
+        if asset in self.assets:
+            self.hits += 1
+            tracked_asset = self.assets.pop(asset)
+            self._store(asset, tracked_asset)
+            return tracked_asset
+        self.misses += 1
+        self.loads.start(asset)
+        try:
+            tracked_asset = config.mongo_db.tracked_assets.find_one({'asset': asset}, {'_id': 0})
+        finally:
+            fresh = self.loads.finish(asset)
+        if fresh and asset not in self.assets:
+            self._store(asset, tracked_asset)
+        return tracked_asset
+
+    def put(self, asset, tracked_asset):
+        self.loads.invalidate(asset)
+        self.assets.pop(asset, None)
+        self._store(asset, tracked_asset)
+
+    def _store(self, asset, tracked_asset):
+        self.assets[asset] = tracked_asset
+        while len(self.assets) > self.max_size:
+            self.assets.popitem(last=False)
+
+    def clear(self):
+        self.loads.invalidate()
+        self.assets.clear()
+
+    def get_stats(self):
+        return {'size': len(self.assets), 'hits': self.hits, 'misses': self.misses}
+
+tracked_asset_cache = TrackedAssetCache()
+
+class BlockIndex(object):
+    """processed_blocks mirrored into compact parallel arrays of block index and block time (as a unix timestamp), so
+    block time and date range lookups don't have to go out to mongo. Loaded by the blockfeed on startup, and kept in
+    step by blockfeed.parse_block and database.rollback"""
+    def __init__(self):
+        self.loaded = False
+        self.block_indexes = array.array('l')
+        self.block_times = array.array('l')
+        self.max_block_times = array.array('l') #running max of block_times (which aren't strictly increasing), for bisecting
+
+    def load(self):
+        self.clear()
+        for block in config.mongo_db.processed_blocks.find(
+          fields={'_id': 0, 'block_index': 1, 'block_time': 1}).sort('block_index', pymongo.ASCENDING):
+            self.append(block['block_index'], block['block_time'])
+        self.loaded = True
+        logger.info("Loaded block index (%i blocks)" % len(self.block_indexes))
+
+    def clear(self):
+        del self.block_indexes[:]
+        del self.block_times[:]
+        del self.max_block_times[:]
+
+    def append(self, block_index, block_time):
+        if self.block_indexes and block_index <= self.block_indexes[-1]:
+            self.truncate(block_index - 1)
+        block_ts = calendar.timegm(block_time.utctimetuple())
+        self.block_indexes.append(block_index)
+        self.block_times.append(block_ts)
+        self.max_block_times.append(max(block_ts, self.max_block_times[-1]) if self.max_block_times else block_ts)
+
+    def truncate(self, max_block_index):
+        pos = bisect.bisect_right(self.block_indexes, max_block_index)
+        del self.block_indexes[pos:]
+        del self.block_times[pos:]
+        del self.max_block_times[pos:]
+
+    def _find(self, block_index):
+        if not self.block_indexes:
+            return None
+        pos = block_index - self.block_indexes[0] #blocks are normally contiguous
+        if not (0 <= pos < len(self.block_indexes) and self.block_indexes[pos] == block_index):
+            pos = bisect.bisect_left(self.block_indexes, block_index)
+            if pos == len(self.block_indexes) or self.block_indexes[pos] != block_index:
+                return None
+        return pos
+
+    def get_block_time(self, block_index):
+        pos = self._find(block_index)
+        return datetime.datetime.utcfromtimestamp(self.block_times[pos]) if pos is not None else None
+
+    def get_last_block_at_or_before(self, dt):
+        """the block index of the last block at or before the given datetime, or None"""
+        pos = bisect.bisect_right(self.max_block_times, calendar.timegm(dt.utctimetuple())) - 1
+        return self.block_indexes[pos] if pos >= 0 else None
+
+    def get_first_block_at_or_after(self, dt):
+        """the block index of the first block at or after the given datetime, or None"""
+        ts = calendar.timegm(dt.utctimetuple()) + (1 if dt.microsecond else 0)
+        pos = bisect.bisect_left(self.max_block_times, ts)
+        return self.block_indexes[pos] if pos < len(self.block_indexes) else None
+
+block_index = BlockIndex()
+
+BLOCK_CACHE_MEMORY_SIZE = 1000 #max number of decoded results to keep in process
+BLOCK_CACHE_REDIS_EXPIRY = 60 * 60 #in seconds
+
+class BlockResultCache(object):
+    """Results of block_cache decorated functions for our latest parsed block, by function signature. Looked up in
+    tiers: decoded in process, then in redis (if the API cache is enabled), then in the counterblockd_cache
+    collection. The blockfeed drops results for older blocks (see clean_block_cache) and database.rollback
+    drops those for blocks rolled back. Callers must treat what get() returns as read-only"""
+    def __init__(self):
+        self.memory = LRUCache(BLOCK_CACHE_MEMORY_SIZE) #function signature -> (block index, block hash, result)
+        self.hits = {'memory': 0, 'redis': 0, 'mongo': 0}
+        self.misses = 0
+
+    def _redis_key(self, function_signature, block_index, block_hash):
+        #(the block hash is in here so that results from before a reorg can't come back)
+        return "block_cache:%s:%s:%s" % (block_index, block_hash, function_signature)
+
+    def get(self, function_signature, block_index, block_hash):
+        """returns the cached result, or None"""
+        entry = self.memory.get(function_signature)
+        if entry is not None and entry[:2] == (block_index, block_hash):
+            self.hits['memory'] += 1
+            return entry[2]
+
+        data = None
+        if config.REDIS_ENABLE_APICACHE:
+            data = config.REDIS_CLIENT.get(self._redis_key(function_signature, block_index, block_hash))
+            if data is not None:
+                self.hits['redis'] += 1
+        if data is None:
+            cached = config.mongo_db.counterblockd_cache.find_one({'block_index': block_index, 'function': function_signature})
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits['mongo'] += 1
+            data = cached['result']
+            if config.REDIS_ENABLE_APICACHE:
+                config.REDIS_CLIENT.setex(self._redis_key(function_signature, block_index, block_hash),
+                    BLOCK_CACHE_REDIS_EXPIRY, data)
+        result = json.loads(data)
+        self.memory.put(function_signature, (block_index, block_hash, result))
+        return result
+
+    def put(self, function_signature, block_index, block_hash, result):
+        data = json.dumps(result)
+        config.mongo_db.counterblockd_cache.insert({
+            'block_index': block_index, 
+            'function': function_signature,
+            'result': data
+        })
+        if config.REDIS_ENABLE_APICACHE:
+            config.REDIS_CLIENT.setex(self._redis_key(function_signature, block_index, block_hash),
+                BLOCK_CACHE_REDIS_EXPIRY, data)
+        self.memory.put(function_signature, (block_index, block_hash, result))
+
+    def clean(self, block_index):
+        """drop results for blocks before block_index"""
+        self.memory.clear() #(anything in here is for an older block by now)
+        config.mongo_db.counterblockd_cache.remove({'block_index': {'$lt': block_index}})
+
+    def truncate(self, max_block_index):
+        """drop results for blocks after max_block_index (on rollback)"""
+        self.memory.clear()
+        config.mongo_db.counterblockd_cache.remove({'block_index': {'$gt': max_block_index}})
+
+    def get_stats(self):
+        lookups = sum(self.hits.values()) + self.misses
+        stats = {'hits': dict(self.hits), 'misses': self.misses}
+        stats['hit_rates'] = dict([(tier, float(hits) / lookups if lookups else None)
+            for tier, hits in self.hits.iteritems()])
+        return stats
+
+block_results = BlockResultCache()
 
 def block_cache(func):
     """decorator"""
     def cached_function(*args, **kwargs):
         
         function_signature = hashlib.sha256(func.__name__ + str(args) + str(kwargs)).hexdigest()
+        block_index = config.state['my_latest_block']['block_index']
+        block_hash = config.state['my_latest_block'].get('block_hash', None)
 
-        sql = "SELECT block_index FROM blocks ORDER BY block_index DESC LIMIT 1"
-        block_index = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': []})['result'][0]['block_index']
-
-        cached_result = config.mongo_db.counterblockd_cache.find_one({'block_index': block_index, 'function': function_signature})
-
-        if not cached_result or config.TESTNET:
+        result = block_results.get(function_signature, block_index, block_hash)
+        if result is None:
             #logger.info("generate cache ({}, {}, {})".format(func.__name__, block_index, function_signature))
             try:
                 result = func(*args, **kwargs)
-                config.mongo_db.counterblockd_cache.insert({
-                    'block_index': block_index, 
-                    'function': function_signature,
-                    'result': json.dumps(result)
-                })
+                block_results.put(function_signature, block_index, block_hash, result)
                 return result
             except Exception, e:
                 logger.exception(e)
         else:
             #logger.info("result from cache ({}, {}, {})".format(func.__name__, block_index, function_signature))
-            result = json.loads(cached_result['result'])
             return result
             
     return cached_function
@@ -67,4 +430,4 @@ def block_cache(func):
 
 def clean_block_cache(block_index):
     #logger.info("clean block cache lower than {}".format(block_index))
-    config.mongo_db.counterblockd_cache.remove({'block_index': {'$lt': block_index}})
+    block_results.clean(block_index)
@@ -5,7 +5,7 @@
 ##
 VERSION = "1.2.0" #should keep up with counterblockd repo's release tag
 
-DB_VERSION = 23 #a db version increment will cause counterblockd to rebuild its database off of counterpartyd 
+DB_VERSION = 26 #a db version increment will cause counterblockd to rebuild its database off of counterpartyd 
 
 UNIT = 100000000
 
@@ -33,6 +33,8 @@ MARKET_LIST_QUOTE_ASSETS = ['XCP', 'XBTC', 'BTC'] # define the order in the mark
 DEFAULT_BACKEND_PORT_TESTNET = 18332
 DEFAULT_BACKEND_PORT = 8332
 
+PROCESSOR_STATS_LOG_NUM_BLOCKS = 1000 #when collecting processor stats, log a summary every this many blocks
+
 
 ##
 ## STATE
@@ -291,6 +293,33 @@ def load(args):
     else:
         REDIS_ENABLE_APICACHE = False
 
+    # connection pooling (for our requests to counterpartyd, bitcoind, etc)
+    global HTTP_POOL_SIZE
+    if args.http_pool_size:
+        HTTP_POOL_SIZE = args.http_pool_size
+    elif has_config and configfile.has_option('Default', 'http-pool-size') and configfile.get('Default', 'http-pool-size'):
+        HTTP_POOL_SIZE = configfile.get('Default', 'http-pool-size')
+    else:
+        HTTP_POOL_SIZE = 10
+    try:
+        HTTP_POOL_SIZE = int(HTTP_POOL_SIZE)
+        assert HTTP_POOL_SIZE >= 1
+    except:
+        raise Exception("Please specific a valid http-pool-size configuration parameter (1 or more)")
+
+    global HTTP_POOL_IDLE_TIMEOUT
+    if args.http_pool_idle_timeout:
+        HTTP_POOL_IDLE_TIMEOUT = args.http_pool_idle_timeout
+    elif has_config and configfile.has_option('Default', 'http-pool-idle-timeout') and configfile.get('Default', 'http-pool-idle-timeout'):
+        HTTP_POOL_IDLE_TIMEOUT = configfile.get('Default', 'http-pool-idle-timeout')
+    else:
+        HTTP_POOL_IDLE_TIMEOUT = 15
+    try:
+        HTTP_POOL_IDLE_TIMEOUT = int(HTTP_POOL_IDLE_TIMEOUT)
+        assert HTTP_POOL_IDLE_TIMEOUT >= 0
+    except:
+        raise Exception("Please specific a valid http-pool-idle-timeout configuration parameter (in seconds)")
+
     ##############
     # THINGS WE SERVE
     
@@ -324,6 +353,22 @@ def load(args):
     else:
         RPC_ALLOW_CORS = True
         
+    global PROCESSOR_STATS
+    if args.processor_stats:
+        PROCESSOR_STATS = args.processor_stats
+    elif has_config and configfile.has_option('Default', 'processor-stats'):
+        PROCESSOR_STATS = configfile.getboolean('Default', 'processor-stats')
+    else:
+        PROCESSOR_STATS = False
+
+    global BLOCK_ARCHIVE
+    if args.block_archive:
+        BLOCK_ARCHIVE = args.block_archive
+    elif has_config and configfile.has_option('Default', 'block-archive'):
+        BLOCK_ARCHIVE = configfile.getboolean('Default', 'block-archive')
+    else:
+        BLOCK_ARCHIVE = False
+
     #Other things
     global SUBDIR_ASSET_IMAGES
     SUBDIR_ASSET_IMAGES = "asset_img%s" % net_path_part #goes under the data dir and stores retrieved asset images
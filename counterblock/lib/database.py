@@ -1,12 +1,16 @@
 import os
 import logging
 import pymongo
+from bson.objectid import ObjectId
 
-from counterblock.lib import config, cache, util
+from counterblock.lib import config, cache, util, blockarchive
 from counterblock.lib.processor import RollbackProcessor
 
 logger = logging.getLogger(__name__)
 
+BULK_WRITE_FLUSH_NUM_BLOCKS = 50 #when bulk writing, flush buffered writes out to mongo every this many blocks
+UNDO_LOG_PRUNE_NUM_BLOCKS = 100 #drop undo log entries too deep to ever be rolled back every this many blocks
+
 def get_connection():
     """Connect to mongodb, returning a connection object"""
     logger.info("Connecting to mongoDB backend ...")
@@ -22,21 +26,257 @@ def init_base_indexes():
     ##COLLECTIONS THAT ARE PURGED AS A RESULT OF A REPARSE
     #processed_blocks
     config.mongo_db.processed_blocks.ensure_index('block_index', unique=True)
+    #undo_log
+    config.mongo_db.undo_log.ensure_index('block_index', unique=True)
+    #address_activity
+    config.mongo_db.address_activity.ensure_index([ #api.get_raw_transactions
+        ("addresses", pymongo.ASCENDING),
+        ("block_index", pymongo.DESCENDING),
+        ("tx_index", pymongo.DESCENDING),
+        ("message_index", pymongo.DESCENDING)
+    ])
+    config.mongo_db.address_activity.ensure_index('key', sparse=True) #(only entries that get updated have one)
+    config.mongo_db.address_activity.ensure_index('block_index')
     ##COLLECTIONS THAT ARE *NOT* PURGED AS A RESULT OF A REPARSE
     #mempool
     config.mongo_db.mempool.ensure_index('tx_hash')
+    #counterblockd_cache
+    config.mongo_db.counterblockd_cache.ensure_index([ #cache.block_results
+        ("function", pymongo.ASCENDING),
+        ("block_index", pymongo.ASCENDING)
+    ])
+    config.mongo_db.counterblockd_cache.ensure_index('block_index')
+
+class WriteBuffer(object):
+    """Buffers the inserts, saves and updates made by processors while we are far behind the tip (i.e. autopilot), and
+    writes them out as bulk operations every BULK_WRITE_FLUSH_NUM_BLOCKS blocks. When not enabled, writes go straight
+    through to mongo.
+
+    undo_log is always written first, so buffered undo records still go out ahead of the changes they undo, and
+    processed_blocks is always written last (and in order), so the highest processed block in the database never
+    runs ahead of the data written for it. If we die mid-flush, the rollback done on startup removes the partial
+    write; if a flush fails while we are running, we roll back the same way and reparse from there."""
+    def __init__(self):
+        self.enabled = False
+        self.inserts = {} #collection name -> {_id: doc}
+        self.saves = {} #collection name -> {_id: doc}, for docs that are already in the database
+        self.updates = {} #collection name -> [(spec, update, upsert)], applied in order after the inserts and saves
+        self.keyed = {} #(collection name, key) -> latest doc buffered under that key
+        self.updated = {} #(collection name, key) -> caller's copy of a doc with buffered updates, with them applied
+        self.num_blocks = 0
+
+    def set_enabled(self, enabled):
+        if self.enabled and not enabled:
+            self.flush()
+        self.enabled = enabled
+
+    def insert(self, collection_name, doc, key=None):
+        if not self.enabled:
+            config.mongo_db[collection_name].insert(doc)
+            return
+        doc['_id'] = ObjectId()
+        self.inserts.setdefault(collection_name, {})[doc['_id']] = doc
+        if key is not None:
+            self.keyed[(collection_name, key)] = doc
+
+    def save(self, collection_name, doc, key=None):
+        if not self.enabled:
+            config.mongo_db[collection_name].save(doc)
+            return
+        if '_id' not in doc:
+            return self.insert(collection_name, doc, key=key)
+        if doc['_id'] in self.inserts.get(collection_name, {}): #not written yet, so just insert the latest version
+            self.inserts[collection_name][doc['_id']] = doc
+        else:
+            self.saves.setdefault(collection_name, {})[doc['_id']] = doc
+        if key is not None:
+            self.keyed[(collection_name, key)] = doc
+
+    def update(self, collection_name, spec, update, upsert=False, key=None, doc=None):
+        """update (the first document matching) spec. Docs still pending under a key should be changed in place
+        instead, as the update may go out in the same flush as their insert. If given, doc (the caller's copy, with
+        the update already applied) is returned by get_updated() under key until the update is written"""
+        if not self.enabled:
+            config.mongo_db[collection_name].update(spec, update, upsert=upsert)
+            return
+        self.updates.setdefault(collection_name, []).append((spec, update, upsert))
+        if key is not None:
+            self.updated[(collection_name, key)] = doc
+
+    def get_updated(self, collection_name, key):
+        """returns the copy of the doc given with the latest buffered update under the given key, or None (in which
+        case the database is up to date)"""
+        return self.updated.get((collection_name, key), None)
+
+    def get_pending(self, collection_name, key):
+        """returns the latest doc buffered (and not yet written) under the given key, or None.
+        Processors that read back what they write must check this before going to the database"""
+        return self.keyed.get((collection_name, key), None)
+
+    def block_done(self):
+        if not self.enabled:
+            return
+        self.num_blocks += 1
+        if self.num_blocks >= BULK_WRITE_FLUSH_NUM_BLOCKS:
+            self.flush()
+
+    def discard(self):
+        self.inserts = {}
+        self.saves = {}
+        self.updates = {}
+        self.keyed = {}
+        self.updated = {}
+        self.num_blocks = 0
+
+    def flush(self):
+        if not self.inserts and not self.saves and not self.updates:
+            return
+        collection_names = sorted(set(self.inserts.keys() + self.saves.keys() + self.updates.keys()),
+            key=lambda x: (x != 'undo_log', x == 'processed_blocks'))
+        processed_blocks = self.inserts.get('processed_blocks', {}).values()
+        try:
+            for collection_name in collection_names:
+                if collection_name == 'processed_blocks': #in order, so a failure leaves no gaps
+                    bulk = config.mongo_db[collection_name].initialize_ordered_bulk_op()
+                    docs = sorted(self.inserts.get(collection_name, {}).values(), key=lambda x: x['block_index'])
+                else:
+                    bulk = config.mongo_db[collection_name].initialize_unordered_bulk_op()
+                    docs = self.inserts.get(collection_name, {}).values()
+                for doc in docs:
+                    bulk.insert(doc)
+                for doc in self.saves.get(collection_name, {}).itervalues():
+                    bulk.find({'_id': doc['_id']}).replace_one(doc)
+                if docs or collection_name in self.saves:
+                    self._execute(bulk, collection_name)
+                if collection_name in self.updates: #(after the inserts, and in order)
+                    bulk = config.mongo_db[collection_name].initialize_ordered_bulk_op()
+                    for spec, update, upsert in self.updates[collection_name]:
+                        if upsert:
+                            bulk.find(spec).upsert().update_one(update)
+                        else:
+                            bulk.find(spec).update_one(update)
+                    self._execute(bulk, collection_name)
+        except Exception, e:
+            logger.exception("Bulk write failed, rolling back to the last block fully written: %s" % e)
+            self.discard()
+            last_block = config.mongo_db.processed_blocks.find_one(sort=[("block_index", pymongo.DESCENDING)])
+            if last_block:
+                rollback(last_block['block_index'])
+            else:
+                reset_db_state()
+                config.state['my_latest_block'] = config.LATEST_BLOCK_INIT
+            return
+        self.discard()
+        if processed_blocks:
+            undo_log.prune(max([b['block_index'] for b in processed_blocks]))
+
+    def _execute(self, bulk, collection_name):
+        try:
+            bulk.execute()
+        except pymongo.errors.BulkWriteError, e:
+            #duplicate keys are logged and skipped, as with single writes (see blockfeed.parse_message)
+            if e.details.get('writeConcernErrors') \
+               or [err for err in e.details['writeErrors'] if err['code'] not in (11000, 11001)]:
+                raise
+            logger.warn("Bulk write to %s skipped %i duplicate(s)" % (collection_name, len(e.details['writeErrors'])))
+
+write_buffer = WriteBuffer()
+
+class UndoLog(object):
+    """A per-block log of how to undo the in-place changes processors make to documents (for collections that are
+    only appended to by block, a range delete on block_index is enough, and processors should do that instead).
+    Processors record the undo op *before* making the change (write-ahead), so the log always covers what is in the
+    database, and rollback() replays the ops for the rolled back blocks, newest first.
+
+    Processors whose change itself goes through the write buffer pass buffered=True, so the undo op is buffered
+    along with it (the write buffer writes undo_log out first). Otherwise it is written right away.
+
+    Ops only ever put documents back to a recorded state, so replaying one twice (e.g. if we die mid-rollback and
+    roll back again on startup) is harmless.
+
+    Entries for blocks more than MAX_REORG_NUM_BLOCKS behind the last block written to processed_blocks are never
+    needed again, and are pruned every UNDO_LOG_PRUNE_NUM_BLOCKS blocks (see blockfeed.parse_block), or after each
+    flush while the write buffer is enabled (as the blocks it holds can still be rolled back on startup). The block
+    pruned below is kept in app_config, and rollback() falls back to a full reparse for rollbacks deeper than that."""
+    def _record(self, op, buffered=False):
+        spec, update = {'block_index': config.state['cur_block']['block_index']}, {'$push': {'ops': op}}
+        if buffered:
+            write_buffer.update('undo_log', spec, update, upsert=True)
+        else:
+            config.mongo_db.undo_log.update(spec, update, upsert=True)
+
+    def record_insert(self, collection_name, spec):
+        """undo: remove the document matching spec (which we are about to create)"""
+        self._record({'collection': collection_name, 'spec': spec, 'op': 'remove'})
+
+    def record_replace(self, collection_name, spec, prev_doc):
+        """undo: put back prev_doc (or if None, remove the document matching spec)"""
+        if prev_doc is None:
+            return self.record_insert(collection_name, spec)
+        self._record({'collection': collection_name, 'spec': spec, 'op': 'replace',
+            'doc': dict([(k, v) for k, v in prev_doc.iteritems() if k != '_id'])})
+
+    def record_update(self, collection_name, spec, prev_doc, fields, buffered=False):
+        """undo: set the given fields of the document matching spec back to their values in prev_doc (unsetting any
+        that it didn't have)"""
+        self._record({'collection': collection_name, 'spec': spec, 'op': 'update',
+            'set': dict([(f, prev_doc[f]) for f in fields if f in prev_doc]),
+            'unset': [f for f in fields if f not in prev_doc]}, buffered=buffered)
+
+    def rollback(self, max_block_index):
+        for entry in config.mongo_db.undo_log.find({'block_index': {'$gt': max_block_index}},
+          sort=[('block_index', pymongo.DESCENDING)]):
+            for op in reversed(entry['ops']):
+                self._undo(op)
+            config.mongo_db.undo_log.remove({'_id': entry['_id']})
+
+    def prune(self, block_index):
+        """block_index is the last block written to processed_blocks"""
+        min_block_index = block_index - config.MAX_REORG_NUM_BLOCKS
+        config.mongo_db.app_config.update({}, {'$set': {'undo_log_min_block_index': min_block_index}})
+        config.mongo_db.undo_log.remove({'block_index': {'$lt': min_block_index}})
+
+    def can_rollback(self, max_block_index):
+        """whether the log still has everything for the blocks after max_block_index"""
+        app_config = config.mongo_db.app_config.find_one() or {}
+        return max_block_index + 1 >= app_config.get('undo_log_min_block_index', 0)
+
+    def clear(self):
+        config.mongo_db.undo_log.drop()
+        config.mongo_db.undo_log.ensure_index('block_index', unique=True)
+
+    def _undo(self, op):
+        collection = config.mongo_db[op['collection']]
+        if op['op'] == 'remove':
+            collection.remove(op['spec'])
+        elif op['op'] == 'replace':
+            collection.update(op['spec'], op['doc'], upsert=True)
+        elif op['op'] == 'update':
+            update = {}
+            if op['set']: update['$set'] = op['set']
+            if op['unset']: update['$unset'] = dict([(f, 1) for f in op['unset']])
+            collection.update(op['spec'], update)
+        else:
+            raise Exception("Unknown undo op: %s" % op)
+
+undo_log = UndoLog()
 
 def get_block_indexes_for_dates(start_dt=None, end_dt=None):
     """Returns a 2 tuple (start_block, end_block) result for the block range that encompasses the given start_date
     and end_date unix timestamps"""
     if start_dt is None:
         start_block_index = config.BLOCK_FIRST
+    elif cache.block_index.loaded:
+        start_block_index = cache.block_index.get_last_block_at_or_before(start_dt) or config.BLOCK_FIRST
     else:
         start_block = config.mongo_db.processed_blocks.find_one({"block_time": {"$lte": start_dt} }, sort=[("block_time", pymongo.DESCENDING)])
         start_block_index = config.BLOCK_FIRST if not start_block else start_block['block_index']
     
     if end_dt is None:
         end_block_index = config.state['my_latest_block']['block_index']
+    elif cache.block_index.loaded:
+        end_block_index = cache.block_index.get_first_block_at_or_after(end_dt) \
+            or config.state['my_latest_block']['block_index']
     else:
         end_block = config.mongo_db.processed_blocks.find_one({"block_time": {"$gte": end_dt} }, sort=[("block_time", pymongo.ASCENDING)])
         if not end_block:
@@ -46,14 +286,20 @@ def get_block_indexes_for_dates(start_dt=None, end_dt=None):
     return (start_block_index, end_block_index)
 
 def get_block_time(block_index):
-    """TODO: implement result caching to avoid having to go out to the database"""
+    if cache.block_index.loaded:
+        return cache.block_index.get_block_time(block_index)
     block = config.mongo_db.processed_blocks.find_one({"block_index": block_index })
     if not block: return None
     return block['block_time']
 
 def reset_db_state():
     """boom! blow away all applicable collections in mongo"""
+    write_buffer.discard()
+    cache.block_index.clear()
     config.mongo_db.processed_blocks.drop()
+    config.mongo_db.address_activity.drop()
+    undo_log.clear()
+    init_base_indexes() #(for the collections just dropped)
     
     #create/update default app_config object
     config.mongo_db.app_config.update({}, {
@@ -63,6 +309,7 @@ def reset_db_state():
     'counterpartyd_db_version_minor': None,
     'counterpartyd_running_testnet': None,
     'last_block_assets_compiled': config.BLOCK_FIRST, #for asset data compilation in tasks.py (resets on reparse as well)
+    'undo_log_min_block_index': 0, #undo log entries for blocks below this have been pruned
     }, upsert=True)
     app_config = config.mongo_db.app_config.find()[0]
     
@@ -83,15 +330,28 @@ def rollback(max_block_index):
     (which will get a new cp_latest_block from counterpartyd and resume as appropriate)   
     """
     assert isinstance(max_block_index, (int, long)) and max_block_index >= config.BLOCK_FIRST
+    write_buffer.flush()
     if not config.mongo_db.processed_blocks.find_one({"block_index": max_block_index}):
         raise Exception("Can't roll back to specified block index: %i doesn't exist in database" % max_block_index)
+    if not undo_log.can_rollback(max_block_index):
+        #the in-place changes for some of the blocks to roll back can no longer be undone
+        logger.error("Can't roll back to block %i, past the undo log. Rebuilding from scratch instead ..." % max_block_index)
+        reset_db_state()
+        config.state['my_latest_block'] = {'block_index': config.BLOCK_FIRST, 'block_time': None, 'block_hash': None}
+        #^ (as config.LATEST_BLOCK_INIT, which isn't set yet if we're called from the command line)
+        return
     
     logger.warn("Pruning to block %i ..." % (max_block_index))        
     config.mongo_db.processed_blocks.remove({"block_index": {"$gt": max_block_index}})
+    cache.block_index.truncate(max_block_index)
+    cache.block_results.truncate(max_block_index)
+    undo_log.rollback(max_block_index)
+    config.mongo_db.address_activity.remove({"block_index": {"$gt": max_block_index}})
 
     config.state['last_message_index'] = -1
     config.state['caught_up'] = False
-    cache.blockinfo_cache.clear()
+    cache.block_prefetcher.reset()
+    blockarchive.archive.discard_pending(max_block_index) #not yet archived, and may be orphaned
     config.state['my_latest_block'] = config.mongo_db.processed_blocks.find_one({"block_index": max_block_index}) or config.LATEST_BLOCK_INIT
 
     #call any rollback processors for any extension modules
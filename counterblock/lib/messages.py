@@ -3,7 +3,7 @@ import copy
 import logging
 import pymongo
 
-from counterblock.lib import config, blockchain, database
+from counterblock.lib import config, blockchain, database, cache
 
 logger = logging.getLogger(__name__)
 
@@ -22,21 +22,20 @@ def decorate_message(message, for_txn_history=False):
     
     if message['_category'] in ['credits', 'debits']:
         #find the last balance change on record
-        bal_change = config.mongo_db.balance_changes.find_one({ 'address': message['address'], 'asset': message['asset'] },
-            sort=[("block_time", pymongo.DESCENDING)])
+        bal_change = cache.balance_index.get(message['address'], message['asset'])
         message['_quantity_normalized'] = abs(bal_change['quantity_normalized']) if bal_change else None
         message['_balance'] = bal_change['new_balance'] if bal_change else None
         message['_balance_normalized'] = bal_change['new_balance_normalized'] if bal_change else None
 
     if message['_category'] in ['orders',] and message['_command'] == 'insert':
-        get_asset_info = config.mongo_db.tracked_assets.find_one({'asset': message['get_asset']})
-        give_asset_info = config.mongo_db.tracked_assets.find_one({'asset': message['give_asset']})
+        get_asset_info = cache.tracked_asset_cache.get(message['get_asset'])
+        give_asset_info = cache.tracked_asset_cache.get(message['give_asset'])
         message['_get_asset_divisible'] = get_asset_info['divisible'] if get_asset_info else None
         message['_give_asset_divisible'] = give_asset_info['divisible'] if give_asset_info else None
     
     if message['_category'] in ['order_matches',] and message['_command'] == 'insert':
-        forward_asset_info = config.mongo_db.tracked_assets.find_one({'asset': message['forward_asset']})
-        backward_asset_info = config.mongo_db.tracked_assets.find_one({'asset': message['backward_asset']})
+        forward_asset_info = cache.tracked_asset_cache.get(message['forward_asset'])
+        backward_asset_info = cache.tracked_asset_cache.get(message['backward_asset'])
         message['_forward_asset_divisible'] = forward_asset_info['divisible'] if forward_asset_info else None
         message['_backward_asset_divisible'] = backward_asset_info['divisible'] if backward_asset_info else None
     
@@ -47,7 +46,7 @@ def decorate_message(message, for_txn_history=False):
         )
 
     if message['_category'] in ['dividends', 'sends',]:
-        asset_info = config.mongo_db.tracked_assets.find_one({'asset': message['asset']})
+        asset_info = cache.tracked_asset_cache.get(message['asset'])
         message['_divisible'] = asset_info['divisible'] if asset_info else None
     
     if message['_category'] in ['issuances',]:
@@ -70,16 +69,26 @@ def decorate_message_for_feed(msg, msg_data=None):
     message = decorate_message(message)
     return message
 
+ADDRESS_ACTIVITY_CATEGORIES = ['debits', 'credits', 'burns', 'sends', 'orders', 'order_matches', 'btcpays',
+    'issuances', 'broadcasts', 'bets', 'bet_matches', 'dividends', 'cancels', 'bet_expirations', 'order_expirations',
+    'bet_match_expirations', 'order_match_expirations'] #the entities that make up an address's transaction history
+ADDRESS_ACTIVITY_UPDATE_KEYS = { #entity -> (key field in its update messages, the same field in its inserts)
+    'orders': ('tx_hash', 'tx_hash'),
+    'bets': ('tx_hash', 'tx_hash'),
+    'order_matches': ('order_match_id', 'id'),
+    'bet_matches': ('bet_match_id', 'id'),
+}
+
 def get_address_cols_for_entity(entity):
     if entity in ['debits', 'credits']:
         return ['address',]
     elif entity in ['issuances',]:
-        return ['issuer',]
-    elif entity in ['sends', 'dividends', 'bets', 'cancels', 'orders', 'burns', 'broadcasts', 'btcpays']:
+        return ['issuer', 'source']
+    elif entity in ['sends', 'btcpays']:
+        return ['source', 'destination']
+    elif entity in ['dividends', 'bets', 'cancels', 'orders', 'burns', 'broadcasts', 'order_expirations', 'bet_expirations']:
         return ['source',]
-    #elif entity in ['order_matches', 'bet_matches']:
-    elif entity in ['order_matches', 'order_expirations', 'order_match_expirations',
-                    'bet_matches', 'bet_expirations', 'bet_match_expirations']:
+    elif entity in ['order_matches', 'order_match_expirations', 'bet_matches', 'bet_match_expirations']:
         return ['tx0_address', 'tx1_address']
     else:
         raise Exception("Unknown entity type: %s" % entity)
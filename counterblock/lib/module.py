@@ -4,7 +4,7 @@ import imp
 import logging
 from configobj import ConfigObj
 
-from counterblock.lib import config
+from counterblock.lib import config, processor
 
 logger = logging.getLogger(__name__)
 
@@ -67,6 +67,7 @@ def load_all():
                         processor_functions[func_name][param_name] = param_value
                 else:
                     logger.warn("Attempted to configure a non-existent processor %s" % func_name)
+            processor_functions.invalidate()
             logger.debug(processor_functions)
 
 def toggle(mod, enabled=True):
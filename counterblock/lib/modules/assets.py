@@ -15,9 +15,10 @@ import base64
 import pymongo
 import ConfigParser
 
+from bson.objectid import ObjectId
 import dateutil.parser
 
-from counterblock.lib import config, util, blockfeed, blockchain
+from counterblock.lib import config, util, blockfeed, blockchain, database, cache
 from counterblock.lib.modules import ASSETS_PRIORITY_PARSE_ISSUANCE, ASSETS_PRIORITY_BALANCE_CHANGE
 from counterblock.lib.processor import MessageProcessor, MempoolMessageProcessor, BlockProcessor, StartUpProcessor, CaughtUpProcessor, RollbackProcessor, API, start_task
 
@@ -135,7 +136,7 @@ def get_normalized_balances(addresses):
         {'filters': filters, 'filterop': 'or'}, abort_on_error=True)['result']
 
     isowner = {}
-    owned_assets = config.mongo_db.tracked_assets.find( { '$or': [{'owner': a } for a in addresses] }, { '_history': 0, '_id': 0 } )
+    owned_assets = config.mongo_db.tracked_assets.find( { '$or': [{'owner': a } for a in addresses] }, { '_id': 0 } )
     for o in owned_assets:
       isowner[o['owner'] + o['asset']] = o
 
@@ -143,7 +144,7 @@ def get_normalized_balances(addresses):
     for d in result:
         if not d['quantity'] and ((d['address'] + d['asset']) not in isowner):
             continue #don't include balances with a zero asset value
-        asset_info = config.mongo_db.tracked_assets.find_one({'asset': d['asset']})
+        asset_info = cache.tracked_asset_cache.get(d['asset'])
         divisible = True # XCP and BTC
         if asset_info and 'divisible' in asset_info:
             divisible = asset_info['divisible']
@@ -169,48 +170,47 @@ def get_normalized_balances(addresses):
 @API.add_method
 def get_escrowed_balances(addresses):
     addresses_holder = ','.join(['?' for e in range(0,len(addresses))])
+    calls = {} #(these are all independent, so we make them concurrently)
 
     sql ='''SELECT (source || '_' || give_asset) AS source_asset, source AS address, give_asset AS asset, SUM(give_remaining) AS quantity
             FROM orders
             WHERE source IN ({}) AND status = ? AND give_asset != ?
             GROUP BY source_asset'''.format(addresses_holder)
-    bindings = addresses + ['open', 'BTC']
-    results = util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    calls['orders'] = ("sql", {'query': sql, 'bindings': addresses + ['open', 'BTC']})
 
     sql = '''SELECT (tx0_address || '_' || forward_asset) AS source_asset, tx0_address AS address, forward_asset AS asset, SUM(forward_quantity) AS quantity
              FROM order_matches
              WHERE tx0_address IN ({}) AND forward_asset != ? AND status = ?
              GROUP BY source_asset'''.format(addresses_holder)
-    bindings = addresses + ['BTC', 'pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    calls['order_matches_forward'] = ("sql", {'query': sql, 'bindings': addresses + ['BTC', 'pending']})
 
     sql = '''SELECT (tx1_address || '_' || backward_asset) AS source_asset, tx1_address AS address, backward_asset AS asset, SUM(backward_quantity) AS quantity
              FROM order_matches
              WHERE tx1_address IN ({}) AND backward_asset != ? AND status = ?
              GROUP BY source_asset'''.format(addresses_holder)
-    bindings = addresses + ['BTC', 'pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    calls['order_matches_backward'] = ("sql", {'query': sql, 'bindings': addresses + ['BTC', 'pending']})
 
     sql = '''SELECT source AS address, '{}' AS asset, SUM(wager_remaining) AS quantity
              FROM bets
              WHERE source IN ({}) AND status = ?
              GROUP BY address'''.format(config.XCP, addresses_holder)
-    bindings = addresses + ['open']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    calls['bets'] = ("sql", {'query': sql, 'bindings': addresses + ['open']})
 
     sql = '''SELECT tx0_address AS address, '{}' AS asset, SUM(forward_quantity) AS quantity
              FROM bet_matches
              WHERE tx0_address IN ({}) AND status = ?
              GROUP BY address'''.format(config.XCP, addresses_holder)
-    bindings = addresses + ['pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    calls['bet_matches_forward'] = ("sql", {'query': sql, 'bindings': addresses + ['pending']})
 
     sql = '''SELECT tx1_address AS address, '{}' AS asset, SUM(backward_quantity) AS quantity
              FROM bet_matches
              WHERE tx1_address IN ({}) AND status = ?
              GROUP BY address'''.format(config.XCP, addresses_holder)
-    bindings = addresses + ['pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    calls['bet_matches_backward'] = ("sql", {'query': sql, 'bindings': addresses + ['pending']})
+
+    results = []
+    for escrowed in util.call_jsonrpc_api_multi(calls).itervalues():
+        results += escrowed
 
     escrowed_balances = {}
     for order in results:
@@ -248,7 +248,7 @@ def get_assets_info(assetsList):
             continue
 
         # User-created asset.
-        tracked_asset = config.mongo_db.tracked_assets.find_one({'asset': asset}, {'_id': 0, '_history': 0})
+        tracked_asset = config.mongo_db.tracked_assets.find_one({'asset': asset}, {'_id': 0})
         if not tracked_asset:
             continue #asset not found, most likely
         assets_info.append({
@@ -339,13 +339,17 @@ def get_asset_history(asset, reverse=False):
     * IF type = 'called_back':
       * 'percentage': The percentage of the asset called back (between 0 and 100)
     """
-    asset = config.mongo_db.tracked_assets.find_one({ 'asset': asset }, {"_id":0})
-    if not asset:
-        raise Exception("Unrecognized asset")
+    raw = list(config.mongo_db.tracked_asset_versions.find({ 'asset': asset }, {"_id":0}).sort(
+        [("_at_block", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])) #oldest to newest, ending with the current state
+    if not raw: #no versions are kept for the base assets (XCP and BTC), which are just there from the first block
+        tracked_asset = config.mongo_db.tracked_assets.find_one({'asset': asset}, {"_id":0})
+        if not tracked_asset:
+            raise Exception("Unrecognized asset")
+        raw = [dict({'_change_type': 'created', 'description': '', 'total_issued_normalized': None,
+            '_at_block_time': None}, **tracked_asset)]
     
-    #run down through _history and compose a diff log
+    #run down through the versions and compose a diff log
     history = []
-    raw = asset['_history'] + [asset,] #oldest to newest. add on the current state
     prev = None
     for i in xrange(len(raw)): #oldest to newest
         if i == 0:
@@ -359,7 +363,8 @@ def get_asset_history(asset, reverse=False):
                 'total_issued': raw[i]['total_issued'],
                 'total_issued_normalized': raw[i]['total_issued_normalized'],
                 'at_block': raw[i]['_at_block'],
-                'at_block_time': time.mktime(raw[i]['_at_block_time'].timetuple()) * 1000,
+                'at_block_time': time.mktime(raw[i]['_at_block_time'].timetuple()) * 1000 \
+                    if raw[i]['_at_block_time'] else None,
             })
             prev = raw[i]
             continue
@@ -445,7 +450,7 @@ def get_balance_history(asset, addresses, normalize=True, start_ts=None, end_ts=
         results.append(entry)
     return results
 
-@MessageProcessor.subscribe(priority=ASSETS_PRIORITY_PARSE_ISSUANCE)
+@MessageProcessor.subscribe(priority=ASSETS_PRIORITY_PARSE_ISSUANCE, categories=['issuances'])
 def parse_issuance(msg, msg_data):
     if msg['category'] != 'issuances': return
     if msg_data['status'] != 'valid': return
@@ -456,6 +461,8 @@ def parse_issuance(msg, msg_data):
     def modify_extended_asset_info(asset, description):
         """adds an asset to asset_extended_info collection if the description is a valid json link. or, if the link
         is not a valid json link, will remove the asset entry from the table if it exists"""
+        database.undo_log.record_replace('asset_extended_info', {'asset': asset},
+            config.mongo_db.asset_extended_info.find_one({'asset': asset}))
         if util.is_valid_url(description, suffix='.json', allow_no_protocol=True):
             config.mongo_db.asset_extended_info.update({'asset': asset},
                 {'$set': {
@@ -474,44 +481,48 @@ def parse_issuance(msg, msg_data):
             if os.path.exists(imagePath):
                 os.remove(imagePath)
 
-    tracked_asset = config.mongo_db.tracked_assets.find_one(
-        {'asset': msg_data['asset']}, {'_id': 0, '_history': 0})
-    #^ pulls the tracked asset without the _id and history fields. This may be None
+    def add_tracked_asset_version(version):
+        #every version (including the current one) goes into tracked_asset_versions, for point-in-time lookups
+        version = dict(version, _id=ObjectId())
+        database.undo_log.record_insert('tracked_asset_versions', {'_id': version['_id']})
+        config.mongo_db.tracked_asset_versions.insert(version)
+
+    def update_tracked_asset(changes):
+        database.undo_log.record_update('tracked_assets', {'asset': msg_data['asset']}, tracked_asset, changes.keys())
+        config.mongo_db.tracked_assets.update({'asset': msg_data['asset']}, {"$set": changes}, upsert=False)
+        add_tracked_asset_version(dict(tracked_asset, **changes))
+
+    tracked_asset = cache.tracked_asset_cache.get(msg_data['asset'])
+    #^ the tracked asset without the _id field. This may be None
     
     if msg_data['locked']: #lock asset
         assert tracked_asset is not None
-        config.mongo_db.tracked_assets.update(
-            {'asset': msg_data['asset']},
-            {"$set": {
-                '_at_block': cur_block_index,
-                '_at_block_time': cur_block['block_time_obj'], 
-                '_change_type': 'locked',
-                'locked': True,
-             },
-             "$push": {'_history': tracked_asset } }, upsert=False)
+        changes = {
+            '_at_block': cur_block_index,
+            '_at_block_time': cur_block['block_time_obj'], 
+            '_change_type': 'locked',
+            'locked': True,
+        }
+        update_tracked_asset(changes)
         logger.info("Locking asset %s" % (msg_data['asset'],))
     elif msg_data['transfer']: #transfer asset
         assert tracked_asset is not None
-        config.mongo_db.tracked_assets.update(
-            {'asset': msg_data['asset']},
-            {"$set": {
-                '_at_block': cur_block_index,
-                '_at_block_time': cur_block['block_time_obj'], 
-                '_change_type': 'transferred',
-                'owner': msg_data['issuer'],
-             },
-             "$push": {'_history': tracked_asset } }, upsert=False)
+        changes = {
+            '_at_block': cur_block_index,
+            '_at_block_time': cur_block['block_time_obj'], 
+            '_change_type': 'transferred',
+            'owner': msg_data['issuer'],
+        }
+        update_tracked_asset(changes)
         logger.info("Transferring asset %s to address %s" % (msg_data['asset'], msg_data['issuer']))
     elif msg_data['quantity'] == 0 and tracked_asset is not None: #change description
-        config.mongo_db.tracked_assets.update(
-            {'asset': msg_data['asset']},
-            {"$set": {
-                '_at_block': cur_block_index,
-                '_at_block_time': cur_block['block_time_obj'], 
-                '_change_type': 'changed_description',
-                'description': msg_data['description'],
-             },
-             "$push": {'_history': tracked_asset } }, upsert=False)
+        changes = {
+            '_at_block': cur_block_index,
+            '_at_block_time': cur_block['block_time_obj'], 
+            '_change_type': 'changed_description',
+            'description': msg_data['description'],
+        }
+        update_tracked_asset(changes)
         modify_extended_asset_info(msg_data['asset'], msg_data['description'])
         logger.info("Changing description for asset %s to '%s'" % (msg_data['asset'], msg_data['description']))
     else: #issue new asset or issue addition qty of an asset
@@ -521,7 +532,7 @@ def parse_issuance(msg, msg_data):
                 '_at_block': cur_block_index, #the block ID this asset is current for
                 '_at_block_time': cur_block['block_time_obj'], 
                 #^ NOTE: (if there are multiple asset tracked changes updates in a single block for the same
-                # asset, the last one with _at_block == that block id in the history array is the
+                # asset, the last one with _at_block == that block id in tracked_asset_versions is the
                 # final version for that asset at that block
                 'asset': msg_data['asset'],
                 'owner': msg_data['issuer'],
@@ -530,48 +541,46 @@ def parse_issuance(msg, msg_data):
                 'locked': False,
                 'total_issued': int(msg_data['quantity']),
                 'total_issued_normalized': blockchain.normalize_quantity(msg_data['quantity'], msg_data['divisible']),
-                '_history': [] #to allow for block rollbacks
             }
-            config.mongo_db.tracked_assets.insert(tracked_asset)
+            changes = {}
+            database.undo_log.record_insert('tracked_assets', {'asset': msg_data['asset']})
+            config.mongo_db.tracked_assets.insert(dict(tracked_asset))
+            add_tracked_asset_version(tracked_asset)
             logger.info("Tracking new asset: %s" % msg_data['asset'])
             modify_extended_asset_info(msg_data['asset'], msg_data['description'])
         else: #issuing additional of existing asset
             assert tracked_asset is not None
-            config.mongo_db.tracked_assets.update(
-                {'asset': msg_data['asset']},
-                {"$set": {
-                    '_at_block': cur_block_index,
-                    '_at_block_time': cur_block['block_time_obj'], 
-                    '_change_type': 'issued_more',
-                 },
-                 "$inc": {
-                     'total_issued': msg_data['quantity'],
-                     'total_issued_normalized': blockchain.normalize_quantity(msg_data['quantity'], msg_data['divisible'])
-                 },
-                 "$push": {'_history': tracked_asset} }, upsert=False)
+            changes = {
+                '_at_block': cur_block_index,
+                '_at_block_time': cur_block['block_time_obj'], 
+                '_change_type': 'issued_more',
+                'total_issued': tracked_asset['total_issued'] + msg_data['quantity'],
+                'total_issued_normalized': tracked_asset['total_issued_normalized'] \
+                    + blockchain.normalize_quantity(msg_data['quantity'], msg_data['divisible']),
+            }
+            update_tracked_asset(changes)
             logger.info("Adding additional %s quantity for asset %s" % (
                 blockchain.normalize_quantity(msg_data['quantity'], msg_data['divisible']), msg_data['asset']))
+    cache.tracked_asset_cache.put(msg_data['asset'], dict(tracked_asset, **changes))
     return True
 
-@MessageProcessor.subscribe(priority=ASSETS_PRIORITY_BALANCE_CHANGE) #must come after parse_issuance
+@MessageProcessor.subscribe(priority=ASSETS_PRIORITY_BALANCE_CHANGE, categories=['credits', 'debits']) #must come after parse_issuance
 def parse_balance_change(msg, msg_data): 
     #track balance changes for each address
     bal_change = None
     if msg['category'] in ['credits', 'debits',]:
         actionName = 'credit' if msg['category'] == 'credits' else 'debit'
         address = msg_data['address']
-        asset_info = config.mongo_db.tracked_assets.find_one({ 'asset': msg_data['asset'] })
+        asset_info = cache.tracked_asset_cache.get(msg_data['asset'])
         if asset_info is None:
             logger.warn("Credit/debit of %s where asset ('%s') does not exist. Ignoring..." % (msg_data['quantity'], msg_data['asset']))
             return 'continue'
         quantity = msg_data['quantity'] if msg['category'] == 'credits' else -msg_data['quantity']
         quantity_normalized = blockchain.normalize_quantity(quantity, asset_info['divisible'])
 
-        #look up the previous balance to go off of
-        last_bal_change = config.mongo_db.balance_changes.find_one({
-            'address': address,
-            'asset': asset_info['asset']
-        }, sort=[("block_index", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        #look up the previous balance to go off of (which may still be sitting in the write buffer)
+        last_bal_change = database.write_buffer.get_pending('balance_changes', (address, asset_info['asset'])) \
+            or cache.balance_index.get(address, asset_info['asset'])
         
         if last_bal_change \
            and last_bal_change['block_index'] == config.state['cur_block']['block_index']:
@@ -580,7 +589,8 @@ def parse_balance_change(msg, msg_data):
             last_bal_change['quantity_normalized'] += quantity_normalized
             last_bal_change['new_balance'] += quantity
             last_bal_change['new_balance_normalized'] += quantity_normalized
-            config.mongo_db.balance_changes.save(last_bal_change)
+            database.write_buffer.save('balance_changes', last_bal_change, key=(address, asset_info['asset']))
+            cache.balance_index.put(address, asset_info['asset'], last_bal_change)
             logger.info("Procesed %s bal change (UPDATED) from tx %s :: %s" % (actionName, msg['message_index'], last_bal_change))
             bal_change = last_bal_change
         else: #new balance change record for this block
@@ -594,7 +604,8 @@ def parse_balance_change(msg, msg_data):
                 'new_balance': last_bal_change['new_balance'] + quantity if last_bal_change else quantity,
                 'new_balance_normalized': last_bal_change['new_balance_normalized'] + quantity_normalized if last_bal_change else quantity_normalized,
             }
-            config.mongo_db.balance_changes.insert(bal_change)
+            database.write_buffer.insert('balance_changes', bal_change, key=(address, asset_info['asset']))
+            cache.balance_index.put(address, asset_info['asset'], bal_change)
             logger.info("Procesed %s bal change from tx %s :: %s" % (actionName, msg['message_index'], bal_change))
 
 
@@ -613,11 +624,19 @@ def init():
     ])
     #tracked_assets
     config.mongo_db.tracked_assets.ensure_index('asset', unique=True)
-    config.mongo_db.tracked_assets.ensure_index('_at_block') #for tracked asset pruning
     config.mongo_db.tracked_assets.ensure_index([
         ("owner", pymongo.ASCENDING),
         ("asset", pymongo.ASCENDING),
     ])
+    #tracked_asset_versions
+    config.mongo_db.tracked_asset_versions.ensure_index([ #get_asset_history
+        ("asset", pymongo.ASCENDING),
+        ("_at_block", pymongo.ASCENDING)
+    ])
+    config.mongo_db.tracked_asset_versions.ensure_index([ #dex.assets_trading.get_asset_info (at_dt)
+        ("asset", pymongo.ASCENDING),
+        ("_at_block_time", pymongo.DESCENDING)
+    ])
     #feeds (also init in betting module)
     config.mongo_db.feeds.ensure_index('source')
     config.mongo_db.feeds.ensure_index('owner')
@@ -630,9 +649,12 @@ def start_tasks():
 
 @RollbackProcessor.subscribe()
 def process_rollback(max_block_index):
+    cache.balance_index.rollback(max_block_index)
+    cache.tracked_asset_cache.clear()
     if not max_block_index: #full reparse
         config.mongo_db.balance_changes.drop()
         config.mongo_db.tracked_assets.drop()
+        config.mongo_db.tracked_asset_versions.drop()
         config.mongo_db.asset_extended_info.drop()
         #create XCP and BTC assets in tracked_assets
         for asset in [config.XCP, config.BTC]:
@@ -643,32 +665,9 @@ def process_rollback(max_block_index):
                 'locked': False,
                 'total_issued': None,
                 '_at_block': config.BLOCK_FIRST, #the block ID this asset is current for
-                '_history': [] #to allow for block rollbacks
             }
             config.mongo_db.tracked_assets.insert(base_asset)
     else: #rollback
         config.mongo_db.balance_changes.remove({"block_index": {"$gt": max_block_index}})
-        
-        #to roll back the state of the tracked asset, dive into the history object for each asset that has
-        # been updated on or after the block that we are pruning back to
-        assets_to_prune = config.mongo_db.tracked_assets.find({'_at_block': {"$gt": max_block_index}})
-        for asset in assets_to_prune:
-            prev_ver = None
-            while len(asset['_history']):
-                prev_ver = asset['_history'].pop()
-                if prev_ver['_at_block'] <= max_block_index:
-                    break
-            if not prev_ver or prev_ver['_at_block'] > max_block_index:
-                #even the first history version is newer than max_block_index.
-                #in this case, just remove the asset tracking record itself
-                logger.info("Pruning asset %s (last modified @ block %i, removing as no older state available that is <= block %i)" % (
-                    asset['asset'], asset['_at_block'], max_block_index))
-                config.mongo_db.tracked_assets.remove({'asset': asset['asset']})
-            else:
-                #if here, we were able to find a previous version that was saved at or before max_block_index
-                # (which should be prev_ver ... restore asset's values to its values
-                logger.info("Pruning asset %s (last modified @ block %i, pruning to state at block %i)" % (
-                    asset['asset'], asset['_at_block'], max_block_index))
-                prev_ver['_id'] = asset['_id']
-                prev_ver['_history'] = asset['_history']
-                config.mongo_db.tracked_assets.save(prev_ver)
+        #(tracked_assets, tracked_asset_versions and asset_extended_info changes are undone from the undo log,
+        # by database.rollback)
@@ -19,7 +19,7 @@ import flask
 import jsonrpc
 import dateutil.parser
 
-from counterblock.lib import config, util, blockfeed, blockchain
+from counterblock.lib import config, util, blockfeed, blockchain, database
 from counterblock.lib.modules import BETTING_PRIORITY_PARSE_BROADCAST
 from counterblock.lib.processor import MessageProcessor, MempoolMessageProcessor, BlockProcessor, StartUpProcessor, CaughtUpProcessor, RollbackProcessor, API, start_task
 
@@ -181,13 +181,14 @@ def parse_base64_feed(base64_feed):
     feed['feed'] = complete_feed
     return feed
 
-@MessageProcessor.subscribe(priority=BETTING_PRIORITY_PARSE_BROADCAST)
+@MessageProcessor.subscribe(priority=BETTING_PRIORITY_PARSE_BROADCAST, categories=['broadcasts'])
 def parse_broadcast(msg, msg_data): 
     if msg['category'] != 'broadcasts':
         return
 
     save = False
     feed = config.mongo_db.feeds.find_one({'source': msg_data['source']})
+    prev_feed = dict(feed) if feed else None #(changes below only replace top level fields)
     
     if util.is_valid_url(msg_data['text'], allow_no_protocol=True) and msg_data['value'] == -1.0:
         if feed is None: 
@@ -213,6 +214,7 @@ def parse_broadcast(msg, msg_data):
             feed['fee_fraction_int'] = msg_data['fee_fraction_int']
         save = True
     if save:  
+        database.undo_log.record_replace('feeds', {'source': msg_data['source']}, prev_feed)
         config.mongo_db.feeds.save(feed)
     return save
 
@@ -488,7 +488,7 @@ def handle_invalid(msg, msg_data):
         config.state['last_message_index'] = msg['message_index']
         return 'continue'
 
-@MessageProcessor.subscribe(priority=CORE_FIRST_PRIORITY - 1.5)
+@MessageProcessor.subscribe(priority=CORE_FIRST_PRIORITY - 1.5, commands=['reorg'])
 def handle_reorg(msg, msg_data):
     if msg['command'] == 'reorg':
        #send out the message to listening clients (but don't forward along while we're catching up)
@@ -21,7 +21,7 @@ import pymongo
 from bson.son import SON
 import dateutil.parser
 
-from counterblock.lib import config, util, blockfeed, blockchain
+from counterblock.lib import config, util, blockfeed, blockchain, database, cache
 from counterblock.lib.modules import DEX_PRIORITY_PARSE_TRADEBOOK
 from counterblock.lib.processor import MessageProcessor, MempoolMessageProcessor, BlockProcessor, StartUpProcessor, CaughtUpProcessor, RollbackProcessor, API, start_task
 from . import assets_trading, dex
@@ -255,8 +255,8 @@ ask_book_min_pct_fee_provided=None, ask_book_min_pct_fee_required=None, ask_book
     @param: normalized_fee_provided: Only specify if selling BTC. If specified, the order book will be pruned down to only
      show orders at and above this fee_provided
     """
-    base_asset_info = config.mongo_db.tracked_assets.find_one({'asset': base_asset})
-    quote_asset_info = config.mongo_db.tracked_assets.find_one({'asset': quote_asset})
+    base_asset_info = cache.tracked_asset_cache.get(base_asset)
+    quote_asset_info = cache.tracked_asset_cache.get(quote_asset)
     
     if not base_asset_info or not quote_asset_info:
         raise Exception("Invalid asset(s)")
@@ -395,7 +395,7 @@ ask_book_min_pct_fee_provided=None, ask_book_min_pct_fee_required=None, ask_book
     for o in orders:
         #add in the blocktime to help makes interfaces more user-friendly (i.e. avoid displaying block
         # indexes and display datetimes instead)
-        o['block_time'] = time.mktime(util.get_block_time(o['block_index']).timetuple()) * 1000
+        o['block_time'] = time.mktime(database.get_block_time(o['block_index']).timetuple()) * 1000
         
     result = {
         'base_bid_book': base_bid_book,
@@ -507,7 +507,7 @@ def task_compile_asset_market_info():
     start_task(task_compile_asset_market_info, delay=COMPILE_ASSET_MARKET_INFO_PERIOD)                         
 
 
-@MessageProcessor.subscribe(priority=DEX_PRIORITY_PARSE_TRADEBOOK)
+@MessageProcessor.subscribe(priority=DEX_PRIORITY_PARSE_TRADEBOOK, categories=['order_matches'])
 def parse_trade_book(msg, msg_data):
     #book trades
     if (msg['category'] == 'order_matches'
@@ -527,8 +527,8 @@ def parse_trade_book(msg, msg_data):
             assert msg_data['status'] == 'completed' #should not enter a pending state for non BTC matches
             order_match = msg_data
 
-        forward_asset_info = config.mongo_db.tracked_assets.find_one({'asset': order_match['forward_asset']})
-        backward_asset_info = config.mongo_db.tracked_assets.find_one({'asset': order_match['backward_asset']})
+        forward_asset_info = cache.tracked_asset_cache.get(order_match['forward_asset'])
+        backward_asset_info = cache.tracked_asset_cache.get(order_match['backward_asset'])
         assert forward_asset_info and backward_asset_info
         base_asset, quote_asset = util.assets_to_asset_pair(order_match['forward_asset'], order_match['backward_asset'])
         
@@ -566,7 +566,7 @@ def parse_trade_book(msg, msg_data):
             ( D(trade['base_quantity_normalized']) / D(trade['quote_quantity_normalized']) ).quantize(
                 D('.00000000'), rounding=decimal.ROUND_HALF_EVEN))
 
-        config.mongo_db.trades.insert(trade)
+        database.write_buffer.insert('trades', trade)
         logger.info("Procesed Trade from tx %s :: %s" % (msg['message_index'], trade))
 
 
@@ -11,7 +11,7 @@ import cgi
 
 import pymongo
 
-from counterblock.lib import config, database, util, blockchain
+from counterblock.lib import config, database, util, blockchain, cache
 
 D = decimal.Decimal
 logger = logging.getLogger(__name__)
@@ -33,8 +33,8 @@ def get_market_price_summary(asset1, asset2, with_last_trades=0, start_dt=None,
     
     #look for the last max 6 trades within the past 10 day window
     base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
-    base_asset_info = config.mongo_db.tracked_assets.find_one({'asset': base_asset})
-    quote_asset_info = config.mongo_db.tracked_assets.find_one({'asset': quote_asset})
+    base_asset_info = cache.tracked_asset_cache.get(base_asset)
+    quote_asset_info = cache.tracked_asset_cache.get(quote_asset)
     
     if not isinstance(with_last_trades, int) or with_last_trades < 0 or with_last_trades > 30:
         raise Exception("Invalid with_last_trades")
@@ -93,14 +93,10 @@ def get_asset_info(asset, at_dt=None):
     
     if asset not in (config.XCP, config.BTC) and at_dt and asset_info['_at_block_time'] > at_dt:
         #get the asset info at or before the given at_dt datetime
-        for e in reversed(asset_info['_history']): #newest to oldest
-            if e['_at_block_time'] <= at_dt:
-                asset_info = e
-                break
-        else: #asset was created AFTER at_dt
-            asset_info = None
-        if asset_info is None: return None
-        assert asset_info['_at_block_time'] <= at_dt
+        asset_info = config.mongo_db.tracked_asset_versions.find_one(
+            {'asset': asset, '_at_block_time': {'$lte': at_dt}},
+            sort=[('_at_block_time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+        if asset_info is None: return None #asset was created AFTER at_dt
       
     #modify some of the properties of the returned asset_info for BTC and XCP
     if asset == config.BTC:
@@ -398,7 +394,6 @@ def compile_asset_pair_market_info():
           'show_expired': False,
         }, abort_on_error=True)['result']
     pair_data = {}
-    asset_info = {}
     
     def get_price(base_quantity_normalized, quote_quantity_normalized):
         return float(D(quote_quantity_normalized / base_quantity_normalized ))
@@ -407,10 +402,8 @@ def compile_asset_pair_market_info():
     for o in open_orders:
         (base_asset, quote_asset) = util.assets_to_asset_pair(o['give_asset'], o['get_asset'])
         pair = '%s/%s' % (base_asset, quote_asset)
-        base_asset_info = asset_info.get(base_asset, config.mongo_db.tracked_assets.find_one({ 'asset': base_asset }))
-        if base_asset not in asset_info: asset_info[base_asset] = base_asset_info
-        quote_asset_info = asset_info.get(quote_asset, config.mongo_db.tracked_assets.find_one({ 'asset': quote_asset }))
-        if quote_asset not in asset_info: asset_info[quote_asset] = quote_asset_info
+        base_asset_info = cache.tracked_asset_cache.get(base_asset)
+        quote_asset_info = cache.tracked_asset_cache.get(quote_asset)
         
         pair_data.setdefault(pair, {'open_orders_count': 0, 'lowest_ask': None, 'highest_bid': None,
             'completed_trades_count': 0, 'vol_base': 0, 'vol_quote': 0})
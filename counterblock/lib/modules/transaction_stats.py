@@ -16,17 +16,17 @@ import pymongo
 from bson.son import SON
 import dateutil.parser
 
-from counterblock.lib import config, util, blockfeed, blockchain
+from counterblock.lib import config, util, blockfeed, blockchain, database
 from counterblock.lib.processor import MessageProcessor, MempoolMessageProcessor, BlockProcessor, StartUpProcessor, CaughtUpProcessor, RollbackProcessor, API, start_task, CORE_FIRST_PRIORITY
 
 logger = logging.getLogger(__name__)
 
-@MessageProcessor.subscribe(priority=CORE_FIRST_PRIORITY-1) #this priority here is important
+@MessageProcessor.subscribe(priority=CORE_FIRST_PRIORITY-1, commands=['insert']) #this priority here is important
 def parse_insert(msg, msg_data): 
     if msg['command'] == 'insert' \
        and msg['category'] not in ["debits", "credits", "order_matches", "bet_matches",
            "order_expirations", "bet_expirations", "order_match_expirations", "bet_match_expirations", "bet_match_resolutions"]:
-        config.mongo_db.transaction_stats.insert({
+        database.write_buffer.insert('transaction_stats', {
             'block_index': config.state['cur_block']['block_index'],
             'block_time': config.state['cur_block']['block_time_obj'],
             'message_index': msg['message_index'],
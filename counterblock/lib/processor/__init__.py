@@ -1,11 +1,20 @@
+import time
+import heapq
 import logging
+import functools
 import collections
 import gevent.pool
 import gevent.util
 
+from counterblock.lib import config
+
+logger = logging.getLogger(__name__)
+
 CORE_FIRST_PRIORITY = 65535 #arbitrary, must be > 1000, as custom plugins utilize the range of <= 1000
 CORE_LAST_PRIORITY = -1 #arbitrary, must be < 0
 
+PROCESSOR_STATS_NUM_SLOWEST = 5 #number of slowest calls to keep samples of, per processor function
+
 class GreenletGroupWithExceptionCatching(gevent.pool.Group):
     """See https://gist.github.com/progrium/956006"""
     def __init__(self, *args):
@@ -130,16 +139,57 @@ class Dispatcher(collections.MutableMapping):
                 self[attr] = method
 
 
+class ProcessorFunctionStats(object):
+    """call statistics for a single processor function"""
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.returns = {'continue': 0, 'break': 0, 'exception': 0}
+        self.slowest = [] #min-heap of (elapsed, sample)
+
+    def record(self, elapsed, ret, msg):
+        self.calls += 1
+        self.total_time += elapsed
+        if ret in self.returns:
+            self.returns[ret] += 1
+        if len(self.slowest) < PROCESSOR_STATS_NUM_SLOWEST or elapsed > self.slowest[0][0]:
+            sample = {'elapsed': elapsed, 'block_index': config.state.get('cur_block', {}).get('block_index', None)}
+            if isinstance(msg, dict):
+                sample['message_index'] = msg.get('message_index', None)
+                sample['category'] = msg.get('category', None)
+            if len(self.slowest) < PROCESSOR_STATS_NUM_SLOWEST:
+                heapq.heappush(self.slowest, (elapsed, sample))
+            else:
+                heapq.heapreplace(self.slowest, (elapsed, sample))
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'total_time': self.total_time,
+            'avg_time': self.total_time / self.calls if self.calls else None,
+            'returns': dict(self.returns),
+            'slowest': [sample for elapsed, sample in sorted(self.slowest, reverse=True)],
+        }
+
 class Processor(Dispatcher):
     logger = logging.getLogger(__name__)
     
-    def subscribe(self, name=None, priority=0, enabled=True):
+    def __init__(self, *args, **kwargs):
+        super(Processor, self).__init__(*args, **kwargs)
+        self.dispatch_table = {} #(category, command) -> active functions for such messages, in priority order
+        self.stats = None #function name -> ProcessorFunctionStats, when enabled
+    
+    def subscribe(self, name=None, priority=0, enabled=True, categories=None, commands=None):
+        """categories/commands: optional lists of message categories/commands. If given, the function is only
+        dispatched messages that match (see active_functions_for)"""
         def inner(f): 
             default = f.__name__
             if f.__module__ not in ['lib.processor.messages', 'lib.processor.startup',
                 'lib.processor.caughtup', 'lib.processor.blocks' ]: default = "{0}.{1}".format(f.__module__, f.__name__)
             self.method_map[name or default] = {
-                'function': f, 'priority': priority, 'enabled': enabled, 'name': name or default}
+                'function': f, 'priority': priority, 'enabled': enabled, 'name': name or default,
+                'categories': categories, 'commands': commands}
+            self.invalidate()
             return f
         return inner
     
@@ -149,14 +199,70 @@ class Processor(Dispatcher):
     def __repr__(self):
         return str(self.method_map)
     
+    def __setitem__(self, key, value):
+        super(Processor, self).__setitem__(key, value)
+        self.invalidate()
+
+    def __delitem__(self, key):
+        super(Processor, self).__delitem__(key)
+        self.invalidate()
+    
+    def invalidate(self):
+        """drops the dispatch table. Must be called after changing the priority or enabled flag of a function
+        (as module.load_all does)"""
+        self.dispatch_table = {}
+    
     #use iteritems instead ? 
     def active_functions(self): 
         return sorted((func for func in self.values() if func['enabled']), key=lambda x: x['priority'], reverse=True)
     
+    def active_functions_for(self, category, command):
+        """active functions to dispatch a message of the given category and command to, in priority order. This is
+        compiled once per (category, command) and kept until invalidate() is called"""
+        try:
+            return self.dispatch_table[(category, command)]
+        except KeyError:
+            funcs = [self._instrument(func) for func in self.active_functions()
+                if (func.get('categories') is None or category in func['categories'])
+                and (func.get('commands') is None or command in func['commands'])]
+            self.dispatch_table[(category, command)] = funcs
+            return funcs
+    
     def run_active_functions(self, *args, **kwargs): 
-        for func in self.active_functions(): 
+        if (None, None) not in self.dispatch_table:
+            self.dispatch_table[(None, None)] = [self._instrument(func) for func in self.active_functions()]
+        for func in self.dispatch_table[(None, None)]:
             self.logger.debug('starting {}'.format(func['name']))
             func['function'](*args, **kwargs)
+
+    def enable_stats(self):
+        """start collecting call statistics for this processor's functions. Until this is called, functions are
+        dispatched to as-is, and there is no overhead"""
+        if self.stats is None:
+            self.stats = {}
+            self.invalidate()
+
+    def get_stats(self):
+        if self.stats is None:
+            return None
+        return dict([(name, stats.to_dict()) for name, stats in self.stats.iteritems()])
+
+    def _instrument(self, func):
+        if self.stats is None:
+            return func
+        stats = self.stats.setdefault(func['name'], ProcessorFunctionStats())
+        f = func['function']
+        @functools.wraps(f)
+        def timed(*args, **kwargs):
+            start_time = time.time()
+            try:
+                ret = f(*args, **kwargs)
+            except:
+                stats.record(time.time() - start_time, 'exception', args[0] if args else None)
+                raise
+            stats.record(time.time() - start_time, ret, args[0] if args else None)
+            return ret
+        return dict(func, function=timed)
                 
 MessageProcessor = Processor()
 MempoolMessageProcessor = Processor()
@@ -165,3 +271,21 @@ StartUpProcessor= Processor()
 CaughtUpProcessor = Processor()                
 RollbackProcessor = Processor()   
 API = Dispatcher() 
+
+STATS_PROCESSORS = {'MessageProcessor': MessageProcessor, 'MempoolMessageProcessor': MempoolMessageProcessor,
+    'BlockProcessor': BlockProcessor} #processors we can collect call statistics for
+
+def get_all_processor_stats():
+    return dict([(name, processor.get_stats()) for name, processor in STATS_PROCESSORS.iteritems()])
+
+def log_processor_stats(num_functions=10):
+    """log the processor functions that have taken the most time in total"""
+    all_stats = []
+    for processor_name, processor in STATS_PROCESSORS.iteritems():
+        for name, stats in (processor.stats or {}).iteritems():
+            all_stats.append(("%s:%s" % (processor_name, name), stats))
+    for name, stats in heapq.nlargest(num_functions, all_stats, key=lambda x: x[1].total_time):
+        logger.info("Processor stats: %s: %i calls, %.3fs total, %.2fms avg, %.2fms max, returns %s" % (
+            name, stats.calls, stats.total_time, stats.total_time / stats.calls * 1000 if stats.calls else 0,
+            max(stats.slowest)[0] * 1000 if stats.slowest else 0,
+            ', '.join(['%s=%i' % (k, v) for k, v in stats.returns.iteritems() if v]) or 'none'))
@@ -3,15 +3,16 @@ import json
 import re
 import time
 import datetime
-import base64
 import decimal
 import operator
 import logging
 import copy
 import urllib
+import hashlib
 import functools
 from logging import handlers as logging_handlers
 
+import gevent
 from gevent import wsgi
 from geventhttpclient import HTTPClient
 from geventhttpclient.url import URL
@@ -19,23 +20,88 @@ import flask
 import jsonrpc
 import pymongo
 
-from counterblock.lib import config, database, util, blockchain, blockfeed, messages
-from counterblock.lib.processor import API
+from counterblock.lib import config, database, util, blockchain, blockfeed, messages, cache
+from counterblock.lib.processor import API, get_all_processor_stats
 
 API_MAX_LOG_SIZE = 10 * 1024 * 1024 #max log size of 20 MB before rotation (make configurable later)
 API_MAX_LOG_COUNT = 10
+API_MAX_BATCH_SIZE = 100 #max number of calls in a JSON-RPC batch request
+API_BATCH_POOL_SIZE = 8 #max number of calls from a batch request to run at once
+#proxy_to_counterpartyd result caching, by method: (seconds a cached result is fresh for, seconds after that it may
+# still be served while it is refetched in the background)
+DEFAULT_COUNTERPARTYD_API_CACHE_POLICY = (60, 30)
+COUNTERPARTYD_API_CACHE_POLICIES = {
+    'get_running_info': (5, 5),
+    'get_mempool': (5, 5),
+}
 
 decimal.setcontext(decimal.Context(prec=8, rounding=decimal.ROUND_HALF_EVEN))
 D = decimal.Decimal
 logger = logging.getLogger(__name__)
 
+def _rpc_error_response(obj_error, request_id=None):
+    return {'jsonrpc': '2.0', 'error': json.loads(obj_error.json), 'id': request_id}
+
+def _is_rpc_notification(request_data):
+    return isinstance(request_data, dict) and 'id' not in request_data \
+        and request_data.get('jsonrpc', None) == "2.0" and bool(request_data.get('method', None))
+
+def _validate_rpc_request(request_data, allow_notification=False):
+    """returns the JSONRPCInvalidRequest error for a call (request object), or None if it's OK"""
+    if not isinstance(request_data, dict) \
+       or not (('id' in request_data or allow_notification)
+               and request_data.get('jsonrpc', None) == "2.0" and request_data.get('method', None)):
+        # params may be omitted 
+        return jsonrpc.exceptions.JSONRPCInvalidRequest(data="Invalid JSON-RPC 2.0 request format")
+    #only arguments passed as a dict are supported
+    if request_data.get('params', None) and not isinstance(request_data['params'], dict):
+        return jsonrpc.exceptions.JSONRPCInvalidRequest(
+            data='Arguments must be passed as a JSON object (list of unnamed arguments not supported)')
+    return None
+
+def _handle_batch_rpc_request(request_data):
+    """returns the response object for one of the calls in a batch request, or None if it's a notification"""
+    obj_error = _validate_rpc_request(request_data, allow_notification=True)
+    if obj_error:
+        if _is_rpc_notification(request_data): #(errors aren't reported for these)
+            return None
+        return _rpc_error_response(obj_error, request_data.get('id', None) if isinstance(request_data, dict) else None)
+    response = jsonrpc.JSONRPCResponseManager.handle(json.dumps(request_data), API)
+    return response.data if response is not None else None
+
+def handle_rpc_request(request_json):
+    """handles a JSON-RPC 2.0 request, or batch request, made to the API.
+    @return: A 2 tuple of (response data, or None if there is nothing to send back (for a batch of only
+    notifications), the request data (or None if request_json doesn't parse))
+    """
+    try:
+        request_data = json.loads(request_json)
+    except (TypeError, ValueError):
+        return _rpc_error_response(jsonrpc.exceptions.JSONRPCParseError()), None
+
+    if isinstance(request_data, list):
+        if not request_data:
+            return _rpc_error_response(jsonrpc.exceptions.JSONRPCInvalidRequest(data="Empty batch request")), request_data
+        if len(request_data) > API_MAX_BATCH_SIZE:
+            return _rpc_error_response(jsonrpc.exceptions.JSONRPCInvalidRequest(
+                data="Batch requests must contain at most %i calls" % API_MAX_BATCH_SIZE)), request_data
+        with util.request_memo(): #backend lookups repeated within the request are only made once
+            #the calls are independent, so run them concurrently
+            responses = util.pmap(_handle_batch_rpc_request, request_data, pool_size=API_BATCH_POOL_SIZE)
+        return [response for response in responses if response is not None] or None, request_data
+
+    obj_error = _validate_rpc_request(request_data)
+    if obj_error:
+        return json.loads(obj_error.json), request_data
+    with util.request_memo():
+        return jsonrpc.JSONRPCResponseManager.handle(request_json, API).data, request_data
+
 def serve_api():
     # Preferneces are just JSON objects... since we don't force a specific form to the wallet on
     # the server side, this makes it easier for 3rd party wallets (i.e. not Counterwallet) to fully be able to
     # use counterblockd to not only pull useful data, but also load and store their own preferences, containing
     # whatever data they need
     
-    DEFAULT_COUNTERPARTYD_API_CACHE_PERIOD = 60 #in seconds
     app = flask.Flask(__name__)
     assert config.mongo_db
     tx_logger = logging.getLogger("transaction_log") #get transaction logger
@@ -53,6 +119,23 @@ def serve_api():
         #DEPRECIATED 1.5
         return config.state['cp_backend_block_index']
         
+    @API.add_method
+    def get_processor_stats():
+        """per processor function call counts, timings, return codes and slowest calls (if counterblockd was started
+        with processor stats enabled, otherwise None for each processor)"""
+        return get_all_processor_stats()
+        
+    @API.add_method
+    def get_http_pool_stats():
+        """request, error and retry counts and connection usage for each of our connection pools (to counterpartyd,
+        bitcoind, etc)"""
+        return util.get_http_pool_stats()
+        
+    @API.add_method
+    def get_block_cache_stats():
+        """hits (by tier) and misses for the results of block_cache decorated API methods"""
+        return cache.block_results.get_stats()
+        
     @API.add_method
     def get_insight_block_info(block_hash):
         info = blockchain.getBlockInfo(block_hash) #('/api/block/' + block_hash + '/', abort_on_error=True)
@@ -62,9 +145,7 @@ def serve_api():
     def get_chain_address_info(addresses, with_uxtos=True, with_last_txn_hashes=4):
         if not isinstance(addresses, list):
             raise Exception("addresses must be a list of addresses, even if it just contains one address")
-        results = []
-
-        for address in addresses:
+        def get_address_info(address):
             info = blockchain.getaddressinfo(address)
             txns = info['transactions']
             del info['transactions']
@@ -77,17 +158,18 @@ def serve_api():
               result['uxtos'] = blockchain.listunspent(address)
             if with_last_txn_hashes:
               result['last_txns'] = txns
-            results.append(result)
+            return result
 
-        return results
+        return util.pmap(get_address_info, addresses)
 
     @API.add_method
     def get_chain_txns_status(txn_hashes):
         if not isinstance(txn_hashes, list):
             raise Exception("txn_hashes must be a list of txn hashes, even if it just contains one hash")
         results = []
+        tx_infos = blockchain.gettransactions(txn_hashes)
         for tx_hash in txn_hashes:
-            tx_info = blockchain.gettransaction(tx_hash)
+            tx_info = tx_infos.get(tx_hash, None)
             if tx_info:
                 assert tx_info['txid'] == tx_hash
                 results.append({
@@ -116,8 +198,8 @@ def serve_api():
 
     @API.add_method
     def get_script_pub_key(tx_hash, vout_index):
-        tx = blockchain.gettransaction(tx_hash)
-        if 'vout' in tx and len(tx['vout']) > vout_index:
+        tx = blockchain.gettransactions([tx_hash]).get(tx_hash, None)
+        if tx and 'vout' in tx and len(tx['vout']) > vout_index:
           return tx['vout'][vout_index]
         return None
 
@@ -135,160 +217,6 @@ def serve_api():
         @param limit: the maximum number of transactions to return; defaults to ten thousand
         @return: Returns the data, ordered from newest txn to oldest. If any limit is applied, it will cut back from the oldest results
         """
-        def get_address_history(address, start_block=None, end_block=None):
-            address_dict = {}
-            
-            address_dict['balances'] = util.call_jsonrpc_api("get_balances",
-                { 'filters': [{'field': 'address', 'op': '==', 'value': address},],
-                }, abort_on_error=True)['result']
-            
-            address_dict['debits'] = util.call_jsonrpc_api("get_debits",
-                { 'filters': [{'field': 'address', 'op': '==', 'value': address},
-                              {'field': 'quantity', 'op': '>', 'value': 0}],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            
-            address_dict['credits'] = util.call_jsonrpc_api("get_credits",
-                { 'filters': [{'field': 'address', 'op': '==', 'value': address},
-                              {'field': 'quantity', 'op': '>', 'value': 0}],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-        
-            address_dict['burns'] = util.call_jsonrpc_api("get_burns",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-        
-            address_dict['sends'] = util.call_jsonrpc_api("get_sends",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address}, {'field': 'destination', 'op': '==', 'value': address}],
-                  'filterop': 'or',
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            #^ with filterop == 'or', we get all sends where this address was the source OR destination 
-            
-            address_dict['orders'] = util.call_jsonrpc_api("get_orders",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-    
-            address_dict['order_matches'] = util.call_jsonrpc_api("get_order_matches",
-                { 'filters': [{'field': 'tx0_address', 'op': '==', 'value': address}, {'field': 'tx1_address', 'op': '==', 'value': address},],
-                  'filterop': 'or',
-                  'order_by': 'tx0_block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            
-            address_dict['btcpays'] = util.call_jsonrpc_api("get_btcpays",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address}, {'field': 'destination', 'op': '==', 'value': address}],
-                  'filterop': 'or',
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            
-            address_dict['issuances'] = util.call_jsonrpc_api("get_issuances",
-                { 'filters': [{'field': 'issuer', 'op': '==', 'value': address}, {'field': 'source', 'op': '==', 'value': address}],
-                  'filterop': 'or',
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            
-            address_dict['broadcasts'] = util.call_jsonrpc_api("get_broadcasts",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-    
-            address_dict['bets'] = util.call_jsonrpc_api("get_bets",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            
-            address_dict['bet_matches'] = util.call_jsonrpc_api("get_bet_matches",
-                { 'filters': [{'field': 'tx0_address', 'op': '==', 'value': address}, {'field': 'tx1_address', 'op': '==', 'value': address},],
-                  'filterop': 'or',
-                  'order_by': 'tx0_block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            
-            address_dict['dividends'] = util.call_jsonrpc_api("get_dividends",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            
-            address_dict['cancels'] = util.call_jsonrpc_api("get_cancels",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-        
-            address_dict['bet_expirations'] = util.call_jsonrpc_api("get_bet_expirations",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-        
-            address_dict['order_expirations'] = util.call_jsonrpc_api("get_order_expirations",
-                { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-        
-            address_dict['bet_match_expirations'] = util.call_jsonrpc_api("get_bet_match_expirations",
-                { 'filters': [{'field': 'tx0_address', 'op': '==', 'value': address}, {'field': 'tx1_address', 'op': '==', 'value': address},],
-                  'filterop': 'or',
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-        
-            address_dict['order_match_expirations'] = util.call_jsonrpc_api("get_order_match_expirations",
-                { 'filters': [{'field': 'tx0_address', 'op': '==', 'value': address}, {'field': 'tx1_address', 'op': '==', 'value': address},],
-                  'filterop': 'or',
-                  'order_by': 'block_index',
-                  'order_dir': 'asc',
-                  'start_block': start_block,
-                  'end_block': end_block,
-                }, abort_on_error=True)['result']
-            return address_dict
-
         now_ts = time.mktime(datetime.datetime.utcnow().timetuple())
         if not end_ts: #default to current datetime
             end_ts = now_ts
@@ -298,48 +226,58 @@ def serve_api():
             start_dt=datetime.datetime.utcfromtimestamp(start_ts),
             end_dt=datetime.datetime.utcfromtimestamp(end_ts) if now_ts != end_ts else None)
         
-        #make API call to counterparty-server to get all of the data for the specified address
+        #the address's history is indexed as we parse blocks (see processor.messages.track_address_activity)
         txns = []
-        d = get_address_history(address, start_block=start_block_index, end_block=end_block_index)
-        #mash it all together
-        for category, entries in d.iteritems():
-            if category in ['balances',]:
-                continue
-            for e in entries:
-                e['_category'] = category
-                e = messages.decorate_message(e, for_txn_history=True) #DRY
-            txns += entries
-        txns = util.multikeysort(txns, ['-_block_time', '-_tx_index'])
-        txns = txns[0:limit] #TODO: we can trunk before sorting. check if we can use the messages table and use sql order and limit
-        #^ won't be a perfect sort since we don't have tx_indexes for cancellations, but better than nothing
-        #txns.sort(key=operator.itemgetter('block_index'))
+        for activity in config.mongo_db.address_activity.find(
+          {'addresses': address, 'block_index': {'$gte': start_block_index, '$lte': end_block_index}},
+          sort=[('block_index', pymongo.DESCENDING), ('tx_index', pymongo.DESCENDING), ('message_index', pymongo.DESCENDING)],
+          limit=limit):
+            e = activity['data']
+            e['_category'] = activity['category']
+            txns.append(messages.decorate_message(e, for_txn_history=True))
         return txns 
 
+    def _get_counterpartyd_api_cache_policy(method):
+        if method.startswith('create_'): #(these compose transactions off of the address's current unspent outputs)
+            return None
+        return COUNTERPARTYD_API_CACHE_POLICIES.get(method, DEFAULT_COUNTERPARTYD_API_CACHE_POLICY)
+
+    def _call_counterpartyd(method, params, cache_key, cache_policy):
+        block_index = config.state['my_latest_block']['block_index']
+        result = util.call_jsonrpc_api(method, params)
+        if cache_key and result is not None and result.get('error', None) is None:
+            entry = {'block_index': block_index, 'time': time.time(), 'result': result}
+            config.REDIS_CLIENT.setex(cache_key, sum(cache_policy), json.dumps(entry))
+        return result
+
     @API.add_method
     def proxy_to_counterpartyd(method='', params=[]):
         if method=='sql': raise Exception("Invalid method") 
         result = None
-        cache_key = None
+        call_key = 'proxy_to_counterpartyd:%s:%s' % (method, hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest())
+        cache_policy = _get_counterpartyd_api_cache_policy(method)
+        cache_key = call_key if config.REDIS_ENABLE_APICACHE and cache_policy else None
 
-        if config.REDIS_ENABLE_APICACHE: #check for a precached result and send that back instead
+        if cache_key: #check for a precached result and send that back instead
             assert config.REDIS_CLIENT
-            cache_key = method + '||' + base64.b64encode(json.dumps(params).encode()).decode()
-            #^ must use encoding (e.g. base64) since redis doesn't allow spaces in its key names
-            # (also shortens the hashing key for better performance)
-            result = config.REDIS_CLIENT.get(cache_key)
-            if result:
+            entry = config.REDIS_CLIENT.get(cache_key)
+            if entry:
                 try:
-                    result = json.loads(result)
+                    entry = json.loads(entry)
                 except Exception, e:
-                    logging.warn("Error loading JSON from cache: %s, cached data: '%s'" % (e, result))
-                    result = None #skip from reading from cache and just make the API call
+                    logging.warn("Error loading JSON from cache: %s, cached data: '%s'" % (e, entry))
+                    entry = None #skip from reading from cache and just make the API call
+            #results are only good for the block they were fetched at (so a new block invalidates everything)
+            if entry and entry['block_index'] == config.state['my_latest_block']['block_index']:
+                age = time.time() - entry['time']
+                if age <= cache_policy[0]:
+                    result = entry['result']
+                elif age <= sum(cache_policy): #stale: serve it this time, and refresh it in the background
+                    result = entry['result']
+                    gevent.spawn(util.single_flight, call_key, _call_counterpartyd, method, params, cache_key, cache_policy)
         
-        if result is None: #cache miss or cache disabled
-            result = util.call_jsonrpc_api(method, params)
-            if config.REDIS_ENABLE_APICACHE: #cache miss
-                assert config.REDIS_CLIENT
-                config.REDIS_CLIENT.setex(cache_key, DEFAULT_COUNTERPARTYD_API_CACHE_PERIOD, json.dumps(result))
-                #^TODO: we may want to have different cache periods for different types of data
+        if result is None: #cache miss or cache disabled (concurrent identical calls all wait on the first one)
+            result = util.single_flight(call_key, _call_counterpartyd, method, params, cache_key, cache_policy)
         
         if 'error' in result:
             if result['error'].get('data', None):
@@ -448,30 +386,21 @@ def serve_api():
 
         try:
             request_json = flask.request.get_data().decode('utf-8')
-            request_data = json.loads(request_json)
-            assert 'id' in request_data and request_data['jsonrpc'] == "2.0" and request_data['method']
-            # params may be omitted 
-        except:
-            obj_error = jsonrpc.exceptions.JSONRPCInvalidRequest(data="Invalid JSON-RPC 2.0 request format")
-            response = flask.Response(obj_error.json.encode(), 200, mimetype='application/json')
+        except UnicodeDecodeError:
+            request_json = None
+        rpc_response_data, request_data = handle_rpc_request(request_json)
+        if rpc_response_data is None: #only notifications, which get nothing back
+            response = flask.Response('', 204)
             _set_cors_headers(response)
             return response
-            
-        #only arguments passed as a dict are supported
-        if request_data.get('params', None) and not isinstance(request_data['params'], dict):
-            obj_error = jsonrpc.exceptions.JSONRPCInvalidRequest(
-                data='Arguments must be passed as a JSON object (list of unnamed arguments not supported)')
-            response = flask.Response(obj_error.json.encode(), 200, mimetype='application/json')
-            _set_cors_headers(response)
-            return response
-        
-        rpc_response = jsonrpc.JSONRPCResponseManager.handle(request_json, API)
-        rpc_response_json = json.dumps(rpc_response.data, default=util.json_dthandler).encode()
+        rpc_response_json = json.dumps(rpc_response_data, default=util.json_dthandler).encode()
         
         #log the request data
         try:
-            assert 'method' in request_data
-            tx_logger.info("TRANSACTION --- %s ||| REQUEST: %s ||| RESPONSE: %s" % (request_data['method'], request_json, rpc_response_json))
+            methods = [call.get('method', None) if isinstance(call, dict) else None
+                for call in (request_data if isinstance(request_data, list) else [request_data])]
+            tx_logger.info("TRANSACTION --- %s ||| REQUEST: %s ||| RESPONSE: %s" % (
+                ','.join([str(method) for method in methods]), request_json, rpc_response_json))
         except Exception, e:
             logger.info("Could not log transaction: Invalid format: %s" % e)
             
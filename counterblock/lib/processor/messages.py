@@ -4,7 +4,7 @@ import sys
 import gevent
 import decimal
 
-from counterblock.lib import util, config, blockchain, blockfeed, database, messages
+from counterblock.lib import util, config, blockchain, blockfeed, database, messages, blockarchive
 from counterblock.lib.processor import MessageProcessor, CORE_FIRST_PRIORITY, CORE_LAST_PRIORITY, api
 
 D = decimal.Decimal 
@@ -20,7 +20,55 @@ def do_sanity_checks(msg, msg_data):
     
     assert msg['message_index'] > config.state['last_message_index']
 
-@MessageProcessor.subscribe(priority=CORE_FIRST_PRIORITY - 1)
+@MessageProcessor.subscribe(priority=CORE_FIRST_PRIORITY - 0.25, categories=messages.ADDRESS_ACTIVITY_CATEGORIES,
+    commands=['insert', 'update'])
+def track_address_activity(msg, msg_data):
+    """index each history entry under the address(es) involved, for get_raw_transactions"""
+    key_fields = messages.ADDRESS_ACTIVITY_UPDATE_KEYS.get(msg['category'], None)
+    if msg['command'] == 'insert':
+        if msg['category'] in ['debits', 'credits'] and not msg_data['quantity']:
+            return
+        addresses = list(set([msg_data[col] for col in messages.get_address_cols_for_entity(msg['category'])
+            if msg_data.get(col, None)]))
+        if not addresses:
+            return
+        tx_index = msg_data['tx_index'] if 'tx_index' in msg_data else msg_data.get('tx1_index', None)
+        if msg['category'] in ['bet_expirations', 'order_expirations', 'bet_match_expirations', 'order_match_expirations']:
+            tx_index = 0 #(as with decorate_message)
+        activity = {
+            'addresses': addresses,
+            'block_index': msg['block_index'],
+            'tx_index': tx_index,
+            'message_index': msg['message_index'],
+            'category': msg['category'],
+            'data': msg_data,
+        }
+        if key_fields and msg_data.get(key_fields[1], None) is not None:
+            activity['key'] = msg_data[key_fields[1]]
+        database.write_buffer.insert('address_activity', activity,
+            key=(msg['category'], activity['key']) if 'key' in activity else None)
+    elif key_fields and msg_data.get(key_fields[0], None) is not None: #update (e.g. of an order's status)
+        key = msg_data[key_fields[0]]
+        changes = dict([(k, v) for k, v in msg_data.iteritems() if k != key_fields[0]])
+        if not changes:
+            return
+        activity = database.write_buffer.get_pending('address_activity', (msg['category'], key))
+        if activity: #not written yet (and removed by block_index on rollback), so just change it in place
+            activity['data'].update(changes)
+            return
+        activity = database.write_buffer.get_updated('address_activity', (msg['category'], key)) \
+            or config.mongo_db.address_activity.find_one({'category': msg['category'], 'key': key})
+        if not activity:
+            return
+        database.undo_log.record_update('address_activity', {'_id': activity['_id']},
+            dict([('data.' + k, v) for k, v in activity['data'].iteritems()]), ['data.' + k for k in changes],
+            buffered=True)
+        activity['data'].update(changes)
+        database.write_buffer.update('address_activity', {'_id': activity['_id']},
+            {'$set': dict([('data.' + k, v) for k, v in changes.iteritems()])},
+            key=(msg['category'], key), doc=activity)
+
+@MessageProcessor.subscribe(priority=CORE_FIRST_PRIORITY - 1, commands=['reorg'])
 def handle_reorg(msg, msg_data):
     if msg['command'] == 'reorg':
         logger.warn("Blockchain reorginization at block %s" % msg_data['block_index'])
@@ -28,6 +76,8 @@ def handle_reorg(msg, msg_data):
         #prune back to and including the specified message_index
         database.rollback(msg_data['block_index'] - 1)
         assert config.state['my_latest_block']['block_index'] == msg_data['block_index'] - 1
+        if config.BLOCK_ARCHIVE: #shouldn't be needed for reorgs shallower than MAX_REORG_NUM_BLOCKS, but to be safe
+            blockarchive.archive.truncate(msg_data['block_index'] - 1)
 
         #for the current last_message_index (which could have gone down after the reorg), query counterpartyd
         running_info = util.jsonrpc_api("get_running_info", abort_on_error=True)['result']
@@ -0,0 +1,221 @@
+"""
+bench: reparse throughput benchmark
+
+Runs process_cp_blockfeed over a fixed block range against a scratch mongo database, with counterpartyd stood in for
+by a local JSON-RPC server that answers get_blocks, get_running_info, sql, etc. from a fixtures file. Reports
+blocks/sec, messages/sec, mongo ops per block and the time spent in each processor function.
+
+The stock modules (as loaded by the default modules.conf) are all loaded, so counterwallet_iofeeds starts its
+socket.io servers on the ports in its config: don't run this alongside a counterblockd using the same config. The
+mongo op counts come from serverStatus, which counts ops across the whole mongod, so point the config at a mongod
+nothing else is using for numbers that are the benchmark's alone.
+
+Record fixtures for a range once against a live counterpartyd (as set up in your server.conf):
+    python bench.py --record --start-block 310000 --end-block 311000 fixtures.json.gz
+then benchmark against them as often as needed:
+    python bench.py fixtures.json.gz
+"""
+import gevent
+from gevent import monkey; monkey.patch_all()
+
+import os
+import gzip
+import json
+import heapq
+import time
+import logging
+import argparse
+import gevent.event
+import gevent.pywsgi
+
+from counterblock.lib import config, log, blockfeed, util, database
+from counterblock.lib.processor import messages, startup #to register the core processors
+from counterblock.lib.processor import StartUpProcessor, STATS_PROCESSORS, get_all_processor_stats
+#the stock modules (those the default modules.conf loads), for a repeatable setup
+from counterblock.lib.modules import assets, betting, counterwallet, counterwallet_iofeeds, dex, transaction_stats
+
+DEFAULT_SCRATCH_DATABASE = 'counterblockd_bench'
+DEFAULT_STUB_PORT = 14999
+SKIPPED_STARTUP_FUNCTIONS = ['init_redis', 'check_blockchain_service', 'start_cp_blockfeed', 'start_api']
+MONGO_OPCOUNTERS = ['insert', 'query', 'update', 'delete', 'getmore', 'command']
+
+logger = logging.getLogger(__name__)
+
+class Args(object):
+    """stands in for counterblockd's parsed command line arguments (everything else comes from the config file)"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        return None
+
+class Fixtures(object):
+    """recorded counterpartyd responses. In record mode, anything we don't have yet is fetched from (and kept from)
+    the live counterpartyd at endpoint"""
+    def __init__(self, path, endpoint=None, auth=None):
+        self.path = path
+        self.endpoint = endpoint
+        self.auth = auth
+        self.running_info = {}
+        self.blocks = {}
+        self.calls = {}
+        if os.path.exists(path):
+            data = json.load(self._open('rb'))
+            self.running_info = data['running_info']
+            self.blocks = dict([(int(block_index), block) for block_index, block in data['blocks'].iteritems()])
+            self.calls = data['calls']
+
+    def save(self):
+        f = self._open('wb')
+        json.dump({'running_info': self.running_info, 'blocks': self.blocks, 'calls': self.calls}, f)
+        f.close()
+
+    def get_running_info(self):
+        if not self.running_info and self.endpoint:
+            running_info = self._call_live('get_running_info', {})
+            self.running_info = dict([(k, running_info.get(k, None))
+                for k in ('version_major', 'version_minor', 'running_testnet')])
+        return self.running_info
+
+    def get_blocks(self, block_indexes):
+        missing = [block_index for block_index in block_indexes if block_index not in self.blocks]
+        if missing and self.endpoint:
+            for block in self._call_live('get_blocks', {'block_indexes': missing}):
+                self.blocks[block['block_index']] = block
+        return [self.blocks[block_index] for block_index in block_indexes]
+
+    def call(self, method, params):
+        key = "%s %s" % (method, json.dumps(params, sort_keys=True))
+        if key not in self.calls and self.endpoint:
+            self.calls[key] = self._call_live(method, params)
+        return self.calls[key]
+
+    def _call_live(self, method, params):
+        return util.call_jsonrpc_api(method, params, endpoint=self.endpoint, auth=self.auth, abort_on_error=True)['result']
+
+    def _open(self, mode):
+        return gzip.open(self.path, mode) if self.path.endswith('.gz') else open(self.path, mode)
+
+def make_stub_app(fixtures, end_block_index, done):
+    """a WSGI app answering counterpartyd JSON-RPC API calls from fixtures"""
+    def app(environ, start_response):
+        request = json.loads(environ['wsgi.input'].read())
+        method, params = request['method'], request.get('params', None) or {}
+        response = {'jsonrpc': '2.0', 'id': request.get('id', 0)}
+        try:
+            if method == 'get_running_info':
+                if config.state['my_latest_block']['block_index'] >= end_block_index:
+                    #we're through the range: hold the block feed here until the benchmark shuts it down
+                    done.set()
+                    gevent.event.Event().wait()
+                end_block = fixtures.get_blocks([end_block_index])[0]
+                response['result'] = dict(fixtures.get_running_info(),
+                    last_block={'block_index': end_block_index, 'block_hash': end_block['block_hash']},
+                    last_message_index=max([msg['message_index'] for msg in end_block['_messages']] or [0]),
+                    bitcoin_block_count=end_block_index,
+                    db_caught_up=True)
+            elif method == 'get_blocks':
+                response['result'] = fixtures.get_blocks(params['block_indexes'])
+            elif method == 'get_mempool':
+                response['result'] = []
+            else:
+                response['result'] = fixtures.call(method, params)
+        except KeyError, e:
+            response['error'] = {'code': -32000, 'message': "No fixture for %s %s (%s)" % (method, params, e)}
+            logger.error(response['error']['message'])
+        body = json.dumps(response)
+        start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+    return app
+
+def get_mongo_opcounters():
+    """server-wide: includes ops from anything else using the same mongod"""
+    return config.mongo_db.command('serverStatus')['opcounters']
+
+def print_report(num_blocks, num_messages, elapsed, opcounters_start, opcounters_end, num_functions):
+    print("Blocks:   %i in %.2fs (%.2f blocks/sec)" % (num_blocks, elapsed, num_blocks / elapsed))
+    print("Messages: %i (%.2f msgs/sec)" % (num_messages, num_messages / elapsed))
+    print("Mongo ops per block (server-wide, includes any other clients of this mongod): %s" % ', '.join(["%s=%.2f" % (
+        op, (opcounters_end[op] - opcounters_start[op]) / float(num_blocks)) for op in MONGO_OPCOUNTERS]))
+
+    all_stats = []
+    for processor_name, stats in get_all_processor_stats().iteritems():
+        for name, function_stats in (stats or {}).iteritems():
+            all_stats.append(("%s:%s" % (processor_name, name), function_stats))
+    print("Processor time (top %i):" % num_functions)
+    for name, function_stats in heapq.nlargest(num_functions, all_stats, key=lambda x: x[1]['total_time']):
+        print("  %-60s %8i calls %9.3fs total %8.3fms avg (%.1f%%)" % (name, function_stats['calls'],
+            function_stats['total_time'], (function_stats['avg_time'] or 0) * 1000,
+            function_stats['total_time'] / elapsed * 100))
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench', description='counterblockd reparse throughput benchmark')
+    parser.add_argument('fixtures', help='fixtures file (.json or .json.gz) of recorded counterpartyd responses')
+    parser.add_argument('--record', action='store_true', default=False,
+        help='fetch anything not in the fixtures file from the live counterpartyd in the config file, and save it')
+    parser.add_argument('--start-block', type=int, help='first block to parse (defaults to the first block in the fixtures)')
+    parser.add_argument('--end-block', type=int, help='last block to parse (defaults to the last block in the fixtures)')
+    parser.add_argument('--mongodb-database', default=DEFAULT_SCRATCH_DATABASE,
+        help='scratch mongo database to parse into (it is wiped first!)')
+    parser.add_argument('--stub-port', type=int, default=DEFAULT_STUB_PORT, help='port for the stand-in counterpartyd')
+    parser.add_argument('--num-functions', type=int, default=20, help='number of processor functions to report on')
+    parser.add_argument('--config-file', help='the location of the counterblockd configuration file')
+    parser.add_argument('--testnet', action='store_true', default=False, help='use Bitcoin testnet addresses and block numbers')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='sets log level to DEBUG')
+    args = parser.parse_args()
+
+    config.init(Args(config_file=args.config_file, testnet=args.testnet))
+    log.set_up(args.verbose)
+    if args.mongodb_database == config.MONGODB_DATABASE:
+        parser.error("refusing to wipe the configured counterblockd database %s, pick a scratch one" % args.mongodb_database)
+
+    fixtures = Fixtures(args.fixtures,
+        endpoint=config.COUNTERPARTY_RPC if args.record else None, auth=config.COUNTERPARTY_AUTH if args.record else None)
+    if args.record and (args.start_block is None or args.end_block is None):
+        parser.error("--record needs --start-block and --end-block")
+    if not args.record and not fixtures.blocks:
+        parser.error("no blocks in fixtures file %s (record some with --record)" % args.fixtures)
+    start_block_index = args.start_block if args.start_block is not None else min(fixtures.blocks.keys())
+    end_block_index = args.end_block if args.end_block is not None else max(fixtures.blocks.keys())
+    assert start_block_index <= end_block_index
+
+    #stand up counterpartyd
+    done = gevent.event.Event()
+    server = gevent.pywsgi.WSGIServer(('127.0.0.1', args.stub_port),
+        make_stub_app(fixtures, end_block_index, done), log=None)
+    server.start()
+    config.COUNTERPARTY_RPC = 'http://127.0.0.1:%i/api/' % args.stub_port
+    config.COUNTERPARTY_AUTH = None
+
+    #reparse from scratch, starting at start_block_index
+    config.MONGODB_DATABASE = args.mongodb_database
+    config.REPARSE_FORCED = True
+    config.BLOCK_FIRST = start_block_index - 1
+    database.get_connection().connection.drop_database(args.mongodb_database)
+    for func in StartUpProcessor.active_functions(): #init_mongo, module indexes, etc.
+        if func['function'].__name__ not in SKIPPED_STARTUP_FUNCTIONS:
+            func['function']()
+    for processor in STATS_PROCESSORS.itervalues():
+        processor.enable_stats()
+
+    num_messages = sum([len(fixtures.get_blocks([block_index])[0]['_messages'])
+        for block_index in xrange(start_block_index, end_block_index + 1)])
+    opcounters_start = get_mongo_opcounters()
+    start_time = time.time()
+    feed = gevent.spawn(blockfeed.process_cp_blockfeed)
+    while not done.wait(1):
+        if feed.ready():
+            raise Exception("Block feed exited early: %s" % feed.exception)
+    feed.kill()
+    database.write_buffer.set_enabled(False) #flush out anything still buffered
+    elapsed = time.time() - start_time
+    opcounters_end = get_mongo_opcounters()
+    server.stop()
+
+    if args.record:
+        fixtures.save()
+    print_report(end_block_index - start_block_index + 1, num_messages, elapsed,
+        opcounters_start, opcounters_end, args.num_functions)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from counterblock.lib.processor import api
+
+@pytest.fixture
+def echo(monkeypatch):
+    calls = []
+    def echo(value=None):
+        calls.append(value)
+        return value
+    monkeypatch.setitem(api.API, 'echo', echo)
+    return calls
+
+def call(method, request_id=None, **params):
+    request = {'jsonrpc': '2.0', 'method': method, 'params': params}
+    if request_id is not None:
+        request['id'] = request_id
+    return request
+
+def test_batch_request(echo):
+    response, request_data = api.handle_rpc_request(json.dumps([call('echo', 1, value='a'), call('echo', 2, value='b')]))
+    assert sorted([(r['id'], r['result']) for r in response]) == [(1, 'a'), (2, 'b')]
+    assert len(request_data) == 2
+
+def test_batch_notifications_get_no_response(echo):
+    response, _ = api.handle_rpc_request(json.dumps([call('echo', 1, value='a'), call('echo', value='b')]))
+    assert [r['id'] for r in response] == [1]
+    assert sorted(echo) == ['a', 'b'] #(the notification is still run)
+
+    response, _ = api.handle_rpc_request(json.dumps([call('echo', value='a'), call('echo', value='b')]))
+    assert response is None
+
+def test_batch_invalid_calls(echo):
+    response, _ = api.handle_rpc_request(json.dumps([1, {'foo': 'boo'}, call('echo', 3, value='c')]))
+    assert [r['error']['code'] for r in response if 'error' in r] == [-32600, -32600]
+    assert [r['id'] for r in response if 'error' in r] == [None, None]
+    assert [r['result'] for r in response if 'result' in r] == ['c']
+
+def test_parse_error():
+    for request_json in ['{"jsonrpc": "2.0", "method": "echo", "params": {', '[{"jsonrpc": "2.0"', None]:
+        response, request_data = api.handle_rpc_request(request_json)
+        assert isinstance(response, dict)
+        assert response['error']['code'] == -32700
+        assert response['id'] is None
+        assert request_data is None
+
+def test_empty_batch():
+    response, _ = api.handle_rpc_request('[]')
+    assert isinstance(response, dict)
+    assert response['error']['code'] == -32600
+    assert response['id'] is None
+
+def test_oversized_batch(echo):
+    requests = [call('echo', i, value=i) for i in xrange(api.API_MAX_BATCH_SIZE + 1)]
+    response, _ = api.handle_rpc_request(json.dumps(requests))
+    assert isinstance(response, dict)
+    assert response['error']['code'] == -32600
+    assert echo == []
@@ -0,0 +1,146 @@
+import datetime
+
+import pytest
+
+from counterblock.lib import config, cache
+
+class FakeCollection(object):
+    """answers find_one from docs, calling during_lookup first (to stand in for other greenlets running while the
+    query is out)"""
+    def __init__(self, docs=None):
+        self.docs = docs or {}
+        self.during_lookup = None
+        self.lookups = 0
+
+    def find_one(self, spec, *args, **kwargs):
+        self.lookups += 1
+        key = spec.get('asset') if 'address' not in spec else (spec['address'], spec['asset'])
+        doc = self.docs.get(key, None)
+        if self.during_lookup:
+            self.during_lookup()
+        return doc
+
+class FakeDB(object):
+    def __init__(self):
+        self.balance_changes = FakeCollection()
+        self.tracked_assets = FakeCollection()
+
+@pytest.fixture
+def mongo_db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(config, 'mongo_db', db, raising=False)
+    return db
+
+def bal_change(block_index, quantity):
+    return {'block_index': block_index, 'quantity': quantity, 'new_balance': quantity}
+
+def test_balance_index_caches_lookups(mongo_db):
+    mongo_db.balance_changes.docs[('addr', 'XCP')] = bal_change(10, 5)
+    index = cache.LatestBalanceIndex()
+    assert index.get('addr', 'XCP') == bal_change(10, 5)
+    assert index.get('addr', 'XCP') == bal_change(10, 5)
+    assert index.get('addr', 'FOO') is None
+    assert index.get('addr', 'FOO') is None
+    assert mongo_db.balance_changes.lookups == 2
+
+def test_balance_index_is_bounded(mongo_db):
+    index = cache.LatestBalanceIndex(max_size=2)
+    index.put('a', 'XCP', bal_change(1, 1))
+    index.put('b', 'XCP', bal_change(1, 1))
+    index.get('a', 'XCP') #(now the most recently used)
+    index.put('c', 'XCP', bal_change(1, 1))
+    assert list(index.entries.keys()) == [('a', 'XCP'), ('c', 'XCP')]
+
+def test_balance_index_lookup_racing_a_put_is_not_cached(mongo_db):
+    mongo_db.balance_changes.docs[('addr', 'XCP')] = bal_change(10, 5)
+    index = cache.LatestBalanceIndex()
+    mongo_db.balance_changes.during_lookup = lambda: index.put('addr', 'XCP', bal_change(11, 7))
+    assert index.get('addr', 'XCP') == bal_change(10, 5) #(what was read, for this caller)
+    mongo_db.balance_changes.during_lookup = None
+    assert index.get('addr', 'XCP') == bal_change(11, 7)
+
+    #and the same for a rollback
+    index = cache.LatestBalanceIndex()
+    mongo_db.balance_changes.during_lookup = lambda: index.rollback(9)
+    index.get('addr', 'XCP')
+    assert ('addr', 'XCP') not in index.entries
+    assert not index.loads.loading and not index.loads.stale
+
+def test_balance_index_rollback(mongo_db):
+    index = cache.LatestBalanceIndex()
+    index.put('a', 'XCP', bal_change(10, 1))
+    index.put('b', 'XCP', bal_change(12, 2))
+    index.put('c', 'XCP', None)
+    index.rollback(11)
+    assert sorted(index.entries.keys()) == [('a', 'XCP'), ('c', 'XCP')]
+
+    mongo_db.balance_changes.docs[('b', 'XCP')] = bal_change(9, 3)
+    assert index.get('b', 'XCP') == bal_change(9, 3) #(reloaded)
+
+    index.rollback(None) #full reparse
+    assert not index.entries
+
+def test_tracked_asset_cache(mongo_db):
+    mongo_db.tracked_assets.docs['FOO'] = {'asset': 'FOO', 'total_issued': 100}
+    tracked_assets = cache.TrackedAssetCache()
+    assert tracked_assets.get('FOO')['total_issued'] == 100
+    assert tracked_assets.get('BAR') is None
+    assert tracked_assets.get('BAR') is None
+    assert mongo_db.tracked_assets.lookups == 2
+    assert tracked_assets.get_stats() == {'size': 2, 'hits': 1, 'misses': 2}
+
+    tracked_assets.put('FOO', {'asset': 'FOO', 'total_issued': 150})
+    assert tracked_assets.get('FOO')['total_issued'] == 150
+
+    tracked_assets.clear() #(as on rollback)
+    assert tracked_assets.get('FOO')['total_issued'] == 100
+    assert mongo_db.tracked_assets.lookups == 3
+
+def test_tracked_asset_cache_lookup_racing_a_put_is_not_cached(mongo_db):
+    mongo_db.tracked_assets.docs['FOO'] = {'asset': 'FOO', 'total_issued': 100}
+    tracked_assets = cache.TrackedAssetCache()
+    mongo_db.tracked_assets.during_lookup = lambda: tracked_assets.put('FOO', {'asset': 'FOO', 'total_issued': 150})
+    tracked_assets.get('FOO')
+    mongo_db.tracked_assets.during_lookup = None
+    assert tracked_assets.get('FOO')['total_issued'] == 150
+
+    tracked_assets = cache.TrackedAssetCache()
+    mongo_db.tracked_assets.during_lookup = tracked_assets.clear
+    tracked_assets.get('FOO')
+    assert 'FOO' not in tracked_assets.assets
+
+def test_tracked_asset_cache_is_bounded(mongo_db):
+    tracked_assets = cache.TrackedAssetCache(max_size=3)
+    for i in xrange(10):
+        tracked_assets.get('NOSUCHASSET%i' % i)
+    assert list(tracked_assets.assets.keys()) == ['NOSUCHASSET7', 'NOSUCHASSET8', 'NOSUCHASSET9']
+
+def test_block_index():
+    index = cache.BlockIndex()
+    start = datetime.datetime(2014, 1, 1)
+    minutes = [0, 10, 8, 20, 30] #(block times aren't strictly increasing)
+    for i, m in enumerate(minutes):
+        index.append(100 + i, start + datetime.timedelta(minutes=m))
+
+    assert index.get_block_time(102) == start + datetime.timedelta(minutes=8)
+    assert index.get_block_time(99) is None
+    assert index.get_block_time(105) is None
+
+    assert index.get_last_block_at_or_before(start - datetime.timedelta(minutes=1)) is None
+    assert index.get_last_block_at_or_before(start + datetime.timedelta(minutes=9)) == 100
+    assert index.get_last_block_at_or_before(start + datetime.timedelta(minutes=15)) == 102
+    assert index.get_first_block_at_or_after(start + datetime.timedelta(minutes=9)) == 101
+    assert index.get_first_block_at_or_after(start + datetime.timedelta(minutes=20)) == 103
+    assert index.get_first_block_at_or_after(start + datetime.timedelta(minutes=31)) is None
+
+    index.truncate(102)
+    assert list(index.block_indexes) == [100, 101, 102]
+    assert index.get_first_block_at_or_after(start + datetime.timedelta(minutes=15)) is None
+
+    index.append(102, start + datetime.timedelta(minutes=12)) #(a reorg: replaces 102 on)
+    assert list(index.block_indexes) == [100, 101, 102]
+    assert index.get_block_time(102) == start + datetime.timedelta(minutes=12)
+
+    index.clear()
+    assert index.get_block_time(100) is None
+    assert index.get_last_block_at_or_before(start) is None
@@ -0,0 +1,160 @@
+import pytest
+import pymongo
+
+from counterblock.lib import config, database
+
+TEST_DATABASE = 'counterblockd_test' #scratch database (wiped by each test) on the local mongod
+
+class RecordingDB(object):
+    """passes through to a mongo database, noting the collections accessed by name (as the write buffer does)"""
+    def __init__(self, db):
+        self.db = db
+        self.accessed = []
+
+    def __getitem__(self, collection_name):
+        self.accessed.append(collection_name)
+        return self.db[collection_name]
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+@pytest.fixture
+def mongo_db(request, monkeypatch):
+    try:
+        client = pymongo.MongoClient('localhost', 27017, connectTimeoutMS=1000)
+    except pymongo.errors.ConnectionFailure:
+        pytest.skip("no mongod running locally")
+    client.drop_database(TEST_DATABASE)
+    db = client[TEST_DATABASE]
+    db.app_config.insert({'undo_log_min_block_index': 0})
+    monkeypatch.setattr(config, 'mongo_db', db, raising=False)
+    monkeypatch.setattr(config, 'state', {'cur_block': {'block_index': 100}}, raising=False)
+    def reset():
+        database.write_buffer.discard()
+        database.write_buffer.enabled = False
+    reset()
+    request.addfinalizer(lambda: (reset(), client.drop_database(TEST_DATABASE)))
+    return db
+
+def set_cur_block(block_index):
+    config.state['cur_block'] = {'block_index': block_index}
+
+def test_write_buffer_disabled_writes_through(mongo_db):
+    database.write_buffer.insert('trades', {'block_index': 100})
+    database.write_buffer.update('trades', {'block_index': 100}, {'$set': {'price': 1}})
+    assert mongo_db.trades.find_one({'block_index': 100})['price'] == 1
+
+def test_write_buffer_flushes_every_n_blocks(mongo_db):
+    database.write_buffer.set_enabled(True)
+    for i in xrange(database.BULK_WRITE_FLUSH_NUM_BLOCKS):
+        database.write_buffer.insert('trades', {'block_index': 100 + i})
+        database.write_buffer.insert('processed_blocks', {'block_index': 100 + i})
+        assert mongo_db.processed_blocks.count() == 0
+        database.write_buffer.block_done()
+    assert mongo_db.trades.count() == database.BULK_WRITE_FLUSH_NUM_BLOCKS
+    assert mongo_db.processed_blocks.count() == database.BULK_WRITE_FLUSH_NUM_BLOCKS
+    assert not database.write_buffer.inserts
+
+def test_write_buffer_pending_docs(mongo_db):
+    database.write_buffer.set_enabled(True)
+    doc = {'address': 'a', 'asset': 'XCP', 'quantity': 1}
+    database.write_buffer.insert('balance_changes', doc, key=('a', 'XCP'))
+    assert database.write_buffer.get_pending('balance_changes', ('a', 'XCP')) is doc
+    doc = dict(doc, quantity=2)
+    database.write_buffer.save('balance_changes', doc, key=('a', 'XCP'))
+    assert database.write_buffer.get_pending('balance_changes', ('a', 'XCP')) is doc
+    database.write_buffer.set_enabled(False) #(flushes)
+    assert database.write_buffer.get_pending('balance_changes', ('a', 'XCP')) is None
+    assert [d['quantity'] for d in mongo_db.balance_changes.find()] == [2]
+
+def test_write_buffer_flush_order(mongo_db, monkeypatch):
+    recording_db = RecordingDB(mongo_db)
+    monkeypatch.setattr(config, 'mongo_db', recording_db)
+    mongo_db.address_activity.insert({'category': 'orders', 'key': 'tx0', 'data': {'status': 'open'}})
+    database.write_buffer.set_enabled(True)
+
+    database.write_buffer.insert('processed_blocks', {'block_index': 101})
+    database.write_buffer.insert('address_activity', {'category': 'orders', 'key': 'tx1', 'data': {'status': 'open'}})
+    database.write_buffer.update('address_activity', {'key': 'tx1'}, {'$set': {'data.status': 'filled'}})
+    database.write_buffer.update('address_activity', {'key': 'tx1'}, {'$set': {'data.status': 'expired'}})
+    database.undo_log.record_update('address_activity', {'key': 'tx0'}, {'data.status': 'open'}, ['data.status'],
+        buffered=True)
+    database.write_buffer.update('address_activity', {'key': 'tx0'}, {'$set': {'data.status': 'filled'}},
+        key=('orders', 'tx0'), doc={'key': 'tx0', 'data': {'status': 'filled'}})
+    assert database.write_buffer.get_updated('address_activity', ('orders', 'tx0'))['data']['status'] == 'filled'
+    database.write_buffer.insert('processed_blocks', {'block_index': 100})
+    assert mongo_db.undo_log.count() == 0
+    database.write_buffer.flush()
+
+    #undo records go out first, and processed_blocks last (in block order)
+    assert recording_db.accessed[0] == 'undo_log'
+    assert recording_db.accessed[-1] == 'processed_blocks'
+    assert [b['block_index'] for b in mongo_db.processed_blocks.find().sort('$natural', pymongo.ASCENDING)] == [100, 101]
+    #updates are applied after the inserts, in the order they were made
+    assert mongo_db.address_activity.find_one({'key': 'tx1'})['data']['status'] == 'expired'
+    assert mongo_db.address_activity.find_one({'key': 'tx0'})['data']['status'] == 'filled'
+    assert database.write_buffer.get_updated('address_activity', ('orders', 'tx0')) is None
+
+def test_undo_log_rollback(mongo_db):
+    mongo_db.tracked_assets.insert({'asset': 'FOO', 'owner': 'a', 'locked': False})
+
+    set_cur_block(101)
+    prev = mongo_db.tracked_assets.find_one({'asset': 'FOO'})
+    database.undo_log.record_update('tracked_assets', {'asset': 'FOO'}, prev, ['owner', 'description'])
+    mongo_db.tracked_assets.update({'asset': 'FOO'}, {'$set': {'owner': 'b', 'description': 'foo'}})
+
+    set_cur_block(102)
+    database.undo_log.record_replace('tracked_assets', {'asset': 'FOO'},
+        mongo_db.tracked_assets.find_one({'asset': 'FOO'}))
+    mongo_db.tracked_assets.update({'asset': 'FOO'}, {'asset': 'FOO', 'owner': 'c', 'locked': True})
+    database.undo_log.record_insert('tracked_assets', {'asset': 'BAR'})
+    mongo_db.tracked_assets.insert({'asset': 'BAR', 'owner': 'c', 'locked': False})
+
+    database.undo_log.rollback(101)
+    foo = mongo_db.tracked_assets.find_one({'asset': 'FOO'}, {'_id': 0})
+    assert foo == {'asset': 'FOO', 'owner': 'b', 'description': 'foo', 'locked': False}
+    assert mongo_db.tracked_assets.find_one({'asset': 'BAR'}) is None
+    assert [e['block_index'] for e in mongo_db.undo_log.find()] == [101]
+
+    database.undo_log.rollback(100)
+    foo = mongo_db.tracked_assets.find_one({'asset': 'FOO'}, {'_id': 0})
+    assert foo == {'asset': 'FOO', 'owner': 'a', 'locked': False}
+    assert mongo_db.undo_log.count() == 0
+
+def test_undo_log_buffered_records(mongo_db):
+    mongo_db.address_activity.insert({'category': 'orders', 'key': 'tx0', 'data': {'status': 'open'}})
+    database.write_buffer.set_enabled(True)
+    set_cur_block(101)
+    database.undo_log.record_update('address_activity', {'key': 'tx0'}, {'data.status': 'open'}, ['data.status'],
+        buffered=True)
+    database.write_buffer.update('address_activity', {'key': 'tx0'}, {'$set': {'data.status': 'filled'}})
+    assert mongo_db.undo_log.count() == 0 #(buffered along with the change)
+    database.write_buffer.set_enabled(False)
+    assert mongo_db.address_activity.find_one({'key': 'tx0'})['data']['status'] == 'filled'
+
+    database.undo_log.rollback(100)
+    assert mongo_db.address_activity.find_one({'key': 'tx0'})['data']['status'] == 'open'
+
+def test_undo_log_prune(mongo_db):
+    for block_index in xrange(100, 130):
+        set_cur_block(block_index)
+        database.undo_log.record_insert('trades', {'block_index': block_index})
+
+    database.undo_log.prune(125)
+    min_block_index = 125 - config.MAX_REORG_NUM_BLOCKS
+    assert min([e['block_index'] for e in mongo_db.undo_log.find()]) == min_block_index
+    assert mongo_db.undo_log.count() == 130 - min_block_index
+    assert database.undo_log.can_rollback(125 - config.MAX_REORG_NUM_BLOCKS)
+    assert database.undo_log.can_rollback(min_block_index - 1)
+    assert not database.undo_log.can_rollback(min_block_index - 2)
+
+def test_write_buffer_flush_prunes_undo_log(mongo_db):
+    set_cur_block(100)
+    database.undo_log.record_insert('trades', {'block_index': 100})
+    database.write_buffer.set_enabled(True)
+    last_block_index = 100 + config.MAX_REORG_NUM_BLOCKS + 5
+    for block_index in xrange(101, last_block_index + 1):
+        database.write_buffer.insert('processed_blocks', {'block_index': block_index})
+    database.write_buffer.flush()
+    assert mongo_db.undo_log.count() == 0
+    assert mongo_db.app_config.find_one()['undo_log_min_block_index'] == last_block_index - config.MAX_REORG_NUM_BLOCKS
@@ -0,0 +1,128 @@
+import time
+import errno
+import socket
+
+import pytest
+import gevent
+
+from counterblock.lib import util
+
+class FakeResponse(object):
+    status_code = 200
+    def read(self):
+        return '{}'
+
+class FakeHTTPClient(object):
+    created = []
+
+    def __init__(self):
+        self.closed = False
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        client = cls()
+        cls.created.append(client)
+        return client
+
+    def request(self, method, request_uri, body=None, headers=None):
+        return FakeResponse()
+
+    def close(self):
+        self.closed = True
+
+def test_http_client_pool_recycles_idle_client(monkeypatch):
+    monkeypatch.setattr(util, 'HTTPClient', FakeHTTPClient)
+    FakeHTTPClient.created = []
+    pool = util.HTTPClientPool('http://localhost:4000/', size=2, idle_timeout=15)
+
+    assert pool.request('GET', '/') == (200, '{}')
+    pool.request('GET', '/') #still fresh: reused
+    assert pool.stats['clients_created'] == 1
+
+    pool.last_used = time.time() - pool.idle_timeout - 1
+    pool.request('GET', '/')
+    assert pool.stats['clients_created'] == 2
+    assert pool.stats['clients_recycled'] == 1
+    assert FakeHTTPClient.created[0].closed
+    assert pool.client is FakeHTTPClient.created[1]
+    assert pool.stats['in_use'] == 0
+
+class DroppingHTTPClient(FakeHTTPClient):
+    """drops the connection on every other request"""
+    requests = 0
+
+    def request(self, method, request_uri, body=None, headers=None):
+        DroppingHTTPClient.requests += 1
+        if DroppingHTTPClient.requests % 2:
+            raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+        return FakeResponse()
+
+def test_http_client_pool_retries_only_repeatable_requests(monkeypatch):
+    monkeypatch.setattr(util, 'HTTPClient', DroppingHTTPClient)
+    DroppingHTTPClient.requests = 0
+    pool = util.HTTPClientPool('http://localhost:4000/', size=2, idle_timeout=15)
+
+    assert pool.request('GET', '/') == (200, '{}')
+    assert pool.stats['retries'] == 1
+
+    with pytest.raises(socket.error):
+        pool.request('POST', '/', body='{}')
+    assert pool.stats['retries'] == 1
+    assert pool.stats['errors'] == 1
+
+def test_is_idempotent_jsonrpc_method():
+    assert util.is_idempotent_jsonrpc_method('get_balances')
+    assert util.is_idempotent_jsonrpc_method('getrawtransaction')
+    assert not util.is_idempotent_jsonrpc_method('create_send')
+    assert not util.is_idempotent_jsonrpc_method('sendrawtransaction')
+
+def slow_lookup(calls, value, fail=False):
+    calls.append(value)
+    gevent.sleep(0.01) #(so concurrent callers overlap)
+    if fail:
+        raise ValueError(value)
+    return {'value': value}
+
+def test_single_flight_shares_the_call_in_progress():
+    calls = []
+    greenlets = [gevent.spawn(util.single_flight, 'key', slow_lookup, calls, 'a') for i in xrange(5)]
+    gevent.joinall(greenlets, raise_error=True)
+    assert calls == ['a']
+    assert [g.value for g in greenlets] == [{'value': 'a'}] * 5
+    assert greenlets[0].value is greenlets[-1].value
+
+    util.single_flight('key', slow_lookup, calls, 'a') #(done, so made again)
+    assert calls == ['a', 'a']
+
+def test_single_flight_shares_exceptions():
+    calls = []
+    greenlets = [gevent.spawn(util.single_flight, 'key', slow_lookup, calls, 'a', fail=True) for i in xrange(3)]
+    gevent.joinall(greenlets)
+    assert calls == ['a']
+    assert all([isinstance(g.exception, ValueError) for g in greenlets])
+    assert 'key' not in util._single_flights
+
+def test_request_memoized():
+    calls = []
+    @util.request_memoized
+    def lookup(value, fail=False):
+        return slow_lookup(calls, value, fail=fail)
+
+    lookup('a')
+    lookup('a')
+    assert calls == ['a', 'a'] #(no-op outside of a request_memo block)
+
+    calls[:] = []
+    with util.request_memo():
+        results = util.pmap(lookup, ['a', 'b', 'a', 'a', 'b'])
+        assert lookup('a') is results[0]
+        with pytest.raises(ValueError):
+            lookup('c', fail=True)
+        with pytest.raises(ValueError): #(exceptions are memoized too)
+            lookup('c', fail=True)
+    assert sorted(calls) == ['a', 'b', 'c']
+    assert [r['value'] for r in results] == ['a', 'b', 'a', 'a', 'b']
+
+    with util.request_memo(): #(each block starts afresh)
+        lookup('a')
+    assert sorted(calls) == ['a', 'a', 'b', 'c']
@@ -13,14 +13,19 @@ import subprocess
 import calendar
 import hashlib
 import socket
+import functools
+import contextlib
 
 import dateutil.parser
 import gevent
 import gevent.pool
 import gevent.ssl
+import gevent.local
+import gevent.event
 import pymongo
 from geventhttpclient import HTTPClient
 from geventhttpclient.url import URL
+from geventhttpclient.response import HTTPConnectionClosed
 import lxml.html
 from PIL import Image
 from jsonschema import FormatChecker, Draft4Validator, FormatError
@@ -29,6 +34,10 @@ import strict_rfc3339, rfc3987, aniso8601 # not needed here but to ensure that i
 from counterblock.lib import config
 
 JSONRPC_API_REQUEST_TIMEOUT = 50 #in seconds
+PMAP_POOL_SIZE = 8 #default max number of greenlets pmap runs at once
+HTTP_POOL_MAX_ENDPOINTS = 50 #past this many, requests to new endpoints get a one-off connection
+JSONRPC_NON_IDEMPOTENT_METHODS = ['sendrawtransaction', 'importaddress', 'importprivkey', 'importpubkey']
+#^ (along with counterpartyd's create_* methods) not retried if the connection drops, as they may have gone through
 
 D = decimal.Decimal
 logger = logging.getLogger(__name__)
@@ -87,12 +96,115 @@ def jsonrpc_api(method, params=None, endpoint=None, auth=None, abort_on_error=Fa
             time.sleep(retry_interval)
             continue
 
+class HTTPClientPool(object):
+    """keep-alive connections to one endpoint (a geventhttpclient HTTPClient, which holds up to size connections and
+    makes any further concurrent requests wait for one). The connections are replaced once they've been idle for more
+    than idle_timeout seconds, as the other end has likely closed them by then"""
+    def __init__(self, url, size, idle_timeout, **client_kwargs):
+        self.url = url
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.client_kwargs = client_kwargs
+        self.client = None
+        self.last_used = None
+        self.stats = {'requests': 0, 'errors': 0, 'retries': 0, 'clients_created': 0, 'clients_recycled': 0,
+            'in_use': 0, 'max_in_use': 0}
+
+    def _recycle_if_idle(self):
+        #(only when no request is in flight, i.e. before this one marks the pool in use)
+        if self.client is not None and not self.stats['in_use'] and self.last_used is not None \
+           and time.time() - self.last_used > self.idle_timeout:
+            self.client.close()
+            self.client = None
+            self.stats['clients_recycled'] += 1
+
+    def _get_client(self):
+        if self.client is None:
+            self.client = HTTPClient.from_url(self.url, concurrency=self.size, **self.client_kwargs)
+            self.stats['clients_created'] += 1
+        return self.client
+
+    def request(self, method, request_uri, body=None, headers=None, retry=None):
+        """returns (status code, response body). If retry (which defaults to whether method is GET or HEAD), requests
+        whose connection drops are made again once: only pass it for requests that are safe to repeat, as the other
+        end may have acted on the first one"""
+        if retry is None:
+            retry = method in ('GET', 'HEAD')
+        self.stats['requests'] += 1
+        self._recycle_if_idle()
+        self.stats['in_use'] += 1
+        self.stats['max_in_use'] = max(self.stats['max_in_use'], self.stats['in_use'])
+        try:
+            for attempt in xrange(2):
+                try:
+                    r = self._get_client().request(method, request_uri, body=body, headers=headers)
+                    return r.status_code, r.read() #(reading it all out puts the connection back in the pool)
+                except socket.timeout:
+                    raise
+                except (socket.error, HTTPConnectionClosed):
+                    if attempt or not retry:
+                        raise
+                    #most likely a kept-alive connection the other end has since closed: try again (on a new one)
+                    self.stats['retries'] += 1
+        except:
+            self.stats['errors'] += 1
+            raise
+        finally:
+            self.stats['in_use'] -= 1
+            self.last_used = time.time()
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+HTTP_POOLS = {} #(scheme, host, port, timeout) -> HTTPClientPool
+
+def http_request(url, method='GET', body=None, headers=None, timeout=JSONRPC_API_REQUEST_TIMEOUT, retry=None):
+    """makes a request over the (keep-alive) connection pool for url's endpoint (see HTTPClientPool.request).
+    Returns (status code, response body)"""
+    u = URL(url)
+    key = (u.scheme, u.host, u.port, timeout)
+    pool = HTTP_POOLS.get(key, None)
+    if pool is None:
+        client_kwargs = {'connection_timeout': timeout, 'network_timeout': timeout}
+        if u.scheme == "https":
+            client_kwargs.update({'insecure': True, 'ssl_options': {'cert_reqs': gevent.ssl.CERT_NONE}})
+        pool = HTTPClientPool("%s://%s:%s/" % (u.scheme, u.host, u.port),
+            config.HTTP_POOL_SIZE, config.HTTP_POOL_IDLE_TIMEOUT, **client_kwargs)
+        if len(HTTP_POOLS) < HTTP_POOL_MAX_ENDPOINTS:
+            HTTP_POOLS[key] = pool
+        else: #one-off
+            try:
+                return pool.request(method, u.request_uri, body=body, headers=headers, retry=retry)
+            finally:
+                pool.close()
+    return pool.request(method, u.request_uri, body=body, headers=headers, retry=retry)
+
+def get_http_pool_stats():
+    return dict([("%s://%s:%s (timeout %ss)" % key, dict(pool.stats, size=pool.size, idle_timeout=pool.idle_timeout))
+        for key, pool in HTTP_POOLS.iteritems()])
+
+def is_idempotent_jsonrpc_method(method):
+    return not method.startswith('create_') and method not in JSONRPC_NON_IDEMPOTENT_METHODS
+
+def _post_jsonrpc(payload, endpoint, auth):
+    headers = {'Content-Type': 'application/json'}
+    if auth: #auth should be a (username, password) tuple, if specified
+        headers['Authorization'] = http_basic_auth_str(auth[0], auth[1])
+    calls = payload if isinstance(payload, list) else [payload]
+    retry = all([is_idempotent_jsonrpc_method(call['method']) for call in calls])
+    try:
+        return http_request(endpoint, method='POST', body=json.dumps(payload), headers=headers, retry=retry)
+    except Exception, e:
+        raise Exception("Got call_jsonrpc_api request error: %s" % e)
+
 def call_jsonrpc_api(method, params=None, endpoint=None, auth=None, abort_on_error=False):
+    """calls counterpartyd's API, or if given, endpoint's (with auth, if it needs it)"""
     socket.setdefaulttimeout(JSONRPC_API_REQUEST_TIMEOUT)
-    if not endpoint:
+    if not endpoint: #(counterpartyd's credentials only ever go to counterpartyd)
         endpoint = config.COUNTERPARTY_RPC
-    if not auth: 
-        auth = config.COUNTERPARTY_AUTH
+        auth = auth or config.COUNTERPARTY_AUTH
     if not params:
         params = {}
     
@@ -104,66 +216,126 @@ def call_jsonrpc_api(method, params=None, endpoint=None, auth=None, abort_on_err
     if params:
         payload['params'] = params
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Connection':'close', #no keepalive
-    }
-    if auth: #auth should be a (username, password) tuple, if specified 
-        headers['Authorization'] = http_basic_auth_str(auth[0], auth[1])
-    try:
-        u = URL(endpoint)
-        client = HTTPClient.from_url(u, connection_timeout=JSONRPC_API_REQUEST_TIMEOUT,
-            network_timeout=JSONRPC_API_REQUEST_TIMEOUT)
-        r = client.post(u.request_uri, body=json.dumps(payload), headers=headers)
-    except Exception, e:
-        raise Exception("Got call_jsonrpc_api request error: %s" % e)
-    else:
-        if r.status_code != 200:
-            if abort_on_error:
-                raise Exception("Bad status code returned: '%s'. result body: '%s'." % (r.status_code, r.read()))
-            else:
-                logging.warning("Bad status code returned: '%s'. result body: '%s'." % (r.status_code, r.read()))
-                result = None
+    status_code, body = _post_jsonrpc(payload, endpoint, auth)
+    if status_code != 200:
+        if abort_on_error:
+            raise Exception("Bad status code returned: '%s'. result body: '%s'." % (status_code, body))
         else:
-            result = json.loads(r.read())
-    finally:
-        client.close()
+            logging.warning("Bad status code returned: '%s'. result body: '%s'." % (status_code, body))
+            result = None
+    else:
+        result = json.loads(body)
 
     if abort_on_error and 'error' in result and result['error'] is not None:
         raise Exception("Got back error from server: %s" % result['error'])
 
     return result
 
+def call_jsonrpc_api_batch(call_list, endpoint=None, auth=None):
+    """sends call_list (a list of JSON-RPC request objects) as a single batch request, to counterpartyd or endpoint
+    (as call_jsonrpc_api). Returns the list of responses"""
+    socket.setdefaulttimeout(JSONRPC_API_REQUEST_TIMEOUT)
+    if not endpoint:
+        endpoint = config.COUNTERPARTY_RPC
+        auth = auth or config.COUNTERPARTY_AUTH
+    status_code, body = _post_jsonrpc(call_list, endpoint, auth)
+    if status_code != 200:
+        raise Exception("Bad status code returned: '%s'. result body: '%s'." % (status_code, body))
+    return json.loads(body)
+
+def call_jsonrpc_api_multi(calls, endpoint=None, auth=None, pool_size=PMAP_POOL_SIZE):
+    """makes independent API calls concurrently (on a pool of up to pool_size greenlets), aborting on any error.
+    @param calls: A dict of name -> (method, params)
+    @return: A dict of name -> result of the call
+    """
+    names = calls.keys()
+    results = pmap(lambda name: call_jsonrpc_api(calls[name][0], calls[name][1],
+        endpoint=endpoint, auth=auth, abort_on_error=True)['result'], names, pool_size=pool_size)
+    return dict(zip(names, results))
+
 def get_url(url, abort_on_error=False, is_json=True, fetch_timeout=5, auth=None, post_data=None):
     """
     @param post_data: If not None, do a POST request, with the passed data (which should be in the correct string format already)
     """
-    headers = { 'Connection':'close', } #no keepalive
+    headers = {}
     if auth:
         #auth should be a (username, password) tuple, if specified
         headers['Authorization'] = http_basic_auth_str(auth[0], auth[1])
         
     try:
-        u = URL(url)
-        client_kwargs = {'connection_timeout': fetch_timeout, 'network_timeout': fetch_timeout, 'insecure': True}
-        if u.scheme == "https": client_kwargs['ssl_options'] = {'cert_reqs': gevent.ssl.CERT_NONE}
-        client = HTTPClient.from_url(u, **client_kwargs)
         if post_data is not None:
             if is_json:
                 headers['content-type'] = 'application/json'
-            r = client.post(u.request_uri, body=post_data, headers=headers)
+            status_code, result = http_request(url, method='POST', body=post_data, headers=headers, timeout=fetch_timeout)
         else:
-            r = client.get(u.request_uri, headers=headers)
+            status_code, result = http_request(url, headers=headers, timeout=fetch_timeout)
     except Exception, e:
         raise Exception("Got get_url request error: %s" % e)
+    if status_code != 200 and abort_on_error:
+        raise Exception("Bad status code returned: '%s'. result body: '%s'." % (status_code, result))
+    result = json.loads(result) if result and is_json else result
+    return result
+
+_request_memo = gevent.local.local()
+
+@contextlib.contextmanager
+def request_memo():
+    """calls to request_memoized functions made within this block (e.g. while serving one API request) are made
+    once per distinct set of arguments, with every caller getting the same result"""
+    prev_memo = getattr(_request_memo, 'memo', None)
+    _request_memo.memo = prev_memo if prev_memo is not None else {}
+    try:
+        yield
+    finally:
+        _request_memo.memo = prev_memo
+
+def request_memoized(func):
+    """memoize func within the current request_memo block (a no-op outside of one). Concurrent callers of the same
+    lookup wait on the first one instead of making it again. Callers must not modify what they get back."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        memo = getattr(_request_memo, 'memo', None)
+        if memo is None:
+            return func(*args, **kwargs)
+        key = (func, args, tuple(sorted(kwargs.items())))
+        if key in memo:
+            return memo[key].get()
+        memo[key] = result = gevent.event.AsyncResult()
+        try:
+            value = func(*args, **kwargs)
+        except Exception, e:
+            result.set_exception(e)
+            raise
+        result.set(value)
+        return value
+    return wrapper
+
+_single_flights = {} #key -> AsyncResult of the call in progress
+
+def single_flight(key, func, *args, **kwargs):
+    """calls func, unless a call under the same key is already in progress (in another greenlet), in which case
+    that call's result (or exception) is waited for and returned instead"""
+    if key in _single_flights:
+        return _single_flights[key].get()
+    _single_flights[key] = result = gevent.event.AsyncResult()
+    try:
+        value = func(*args, **kwargs)
+    except Exception, e:
+        result.set_exception(e)
+        raise
     else:
-        if r.status_code != 200 and abort_on_error:
-            raise Exception("Bad status code returned: '%s'. result body: '%s'." % (r.status_code, r.read()))
-        result = r.read()
-        result = json.loads(result) if result and is_json else result
+        result.set(value)
+        return value
     finally:
-        client.close()
-    return result
+        del _single_flights[key]
+
+def pmap(func, items, pool_size=PMAP_POOL_SIZE):
+    """like map(), but with func run over items on a bounded gevent pool (in the caller's request_memo, if any)"""
+    memo = getattr(_request_memo, 'memo', None)
+    def run(item):
+        _request_memo.memo = memo
+        return func(item)
+    return gevent.pool.Pool(pool_size).map(run, items)
 
 def grouper(n, iterable, fillmissing=False, fillvalue=None):
     #Modified from http://stackoverflow.com/a/1625013
@@ -174,19 +346,6 @@ def grouper(n, iterable, fillmissing=False, fillvalue=None):
         data = [[e for e in g if e != fillvalue] for g in data]
     return data
 
-def multikeysort(items, columns):
-    """http://stackoverflow.com/a/1144405"""
-    from operator import itemgetter
-    comparers = [ ((itemgetter(col[1:].strip()), -1) if col.startswith('-') else (itemgetter(col.strip()), 1)) for col in columns]  
-    def comparer(left, right):
-        for fn, mult in comparers:
-            result = cmp(fn(left), fn(right))
-            if result:
-                return mult * result
-        else:
-            return 0
-    return sorted(items, cmp=comparer)
-
 def cumsum(iterable):
     values = list(iterable)
     for pos in xrange(1, len(values)):
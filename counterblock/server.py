@@ -59,10 +59,15 @@ def main():
     parser.add_argument('--redis-port', type=int, help='the port used to connect to the redis server for caching (if enabled)')
     parser.add_argument('--redis-database', type=int, help='the redis database ID (int) used to connect to the redis server for caching (if enabled)')
 
+    parser.add_argument('--http-pool-size', type=int, help='the max number of keep-alive connections to keep open to each of counterpartyd, bitcoind, etc')
+    parser.add_argument('--http-pool-idle-timeout', type=int, help='the number of seconds after which idle pooled connections are replaced')
+
     #COUNTERBLOCK API
     parser.add_argument('--rpc-host', help='the IP of the interface to bind to for providing JSON-RPC API access (0.0.0.0 for all interfaces)')
     parser.add_argument('--rpc-port', type=int, help='port on which to provide the counterblockd JSON-RPC API')
     parser.add_argument('--rpc-allow-cors', action='store_true', default=True, help='Allow ajax cross domain request')
+    parser.add_argument('--processor-stats', action='store_true', default=False, help='collect timing statistics for processor functions (see the get_processor_stats API method)')
+    parser.add_argument('--block-archive', action='store_true', default=False, help='keep a local archive of confirmed block data from counterpartyd, and reparse from it instead of refetching')
 
     #actions
     subparsers = parser.add_subparsers(dest='action', help='the action to be taken')